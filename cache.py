@@ -0,0 +1,273 @@
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import faiss
+import numpy as np
+from typing import Callable
+from collections import OrderedDict
+
+def normalize_query(query: str) -> str:
+    """规范化提问文本，统一全角半角并合并空白，用作各类缓存的键"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", query)).strip()
+
+class LRUCache:
+    """线程安全的 LRU 缓存"""
+    maxsize: int = 256
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.data: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.data),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+class ResultCache(LRUCache):
+    """检索结果缓存，每一项记录写入时的索引版本号，重建索引后旧的结果立即失效"""
+    ttl: float = 600
+    """缓存有效期（秒），不大于 0 表示不会过期"""
+
+    def __init__(self, maxsize=256, ttl=600):
+        super().__init__(maxsize)
+        self.ttl = ttl
+        self.stale = 0
+
+    def lookup(self, key, generation: int):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                value, stamp, expires = entry
+                if stamp == generation and (expires is None or expires > time.monotonic()):
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                # 过期或索引已经重建
+                self.data.pop(key)
+                self.stale += 1
+            self.misses += 1
+            return None
+
+    def store(self, key, value, generation: int):
+        expires = time.monotonic() + self.ttl if self.ttl > 0 else None
+        self.put(key, (value, generation, expires))
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        with self.lock:
+            stats["stale"] = self.stale
+        return stats
+
+class SemanticCache:
+    """语义缓存，措辞不同但含义相近的提问直接复用之前的检索结果"""
+    maxsize: int = 256
+    threshold: float = 0.95
+    """余弦相似度阈值，不低于此值的提问视为同一个提问"""
+    generation: int = 0
+    """当前接受的索引版本号，基于旧版本索引的检索结果不会再写入"""
+
+    def __init__(self, maxsize=256, threshold=0.95):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.index: faiss.IndexIDMap2 = None
+        self.entries: OrderedDict[int, list] = OrderedDict()
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _normalize(self, vector: list[float]) -> np.ndarray:
+        arr = np.array([vector], dtype=np.float32)
+        faiss.normalize_L2(arr)
+        return arr
+
+    def lookup(self, vector: list[float]):
+        if self.maxsize <= 0:
+            return None
+        with self.lock:
+            if self.entries:
+                scores, ids = self.index.search(self._normalize(vector), 1)
+                if ids[0][0] != -1 and scores[0][0] >= self.threshold:
+                    self.entries.move_to_end(int(ids[0][0]))
+                    self.hits += 1
+                    return self.entries[int(ids[0][0])]
+            self.misses += 1
+            return None
+
+    def store(self, vector: list[float], docs: list, generation: int):
+        """写入一次检索结果，generation 为检索时使用的索引版本号"""
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            if self.index is None:
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(len(vector)))
+            self.index.add_with_ids(self._normalize(vector), np.array([self.next_id], dtype=np.int64))
+            self.entries[self.next_id] = docs
+            self.next_id += 1
+            if len(self.entries) > self.maxsize:
+                evicted, _ = self.entries.popitem(last=False)
+                self.index.remove_ids(np.array([evicted], dtype=np.int64))
+
+    def invalidate(self, generation: int):
+        """清空缓存，之后只接受基于 generation 版本索引的检索结果"""
+        with self.lock:
+            self.generation = generation
+            self.entries.clear()
+            self.index = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+class EmbeddingCache:
+    """持久化的片段嵌入缓存，键为 (模型名称, 片段内容哈希)，内容相同的片段只会嵌入一次"""
+    max_entries: int = 200000
+    """缓存的最大条目数，写入后超出时立即按最近使用时间淘汰，不大于 0 表示关闭缓存"""
+
+    def __init__(self, path: str, max_entries=200000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn: sqlite3.Connection = None
+        if max_entries > 0:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, used REAL NOT NULL, "
+                "PRIMARY KEY (model, hash))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+            self.conn.commit()
+            # 当前条目数，写入时据此判断是否需要淘汰，不必每次都统计整张表
+            self.size = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _fetch(self, model: str, hashes: list[str]) -> dict[str, list[float]]:
+        found: dict[str, list[float]] = {}
+        # sqlite 对参数数量有限制，分批查询
+        for start in range(0, len(hashes), 500):
+            part = hashes[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(part))})",
+                [model, *part]
+            )
+            for hash, vector in rows:
+                found[hash] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def embed(self, model: str, texts: list[str], embed_func: Callable[[list[str]], list[list[float]]]) -> list[list[float]]:
+        """获取一批片段的向量，只有缓存中不存在的片段才会交给 embed_func 嵌入"""
+        if self.conn is None:
+            return embed_func(texts)
+
+        hashes = [content_hash(text) for text in texts]
+        unique = list(dict.fromkeys(hashes))
+        with self.lock:
+            vectors = self._fetch(model, unique)
+
+        missing = [hash for hash in unique if hash not in vectors]
+        if missing:
+            text_of = dict(zip(hashes, texts))
+            embedded = embed_func([text_of[hash] for hash in missing])
+            vectors.update(zip(missing, embedded))
+
+        now = time.time()
+        with self.lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector, used) VALUES (?, ?, ?, ?)",
+                [(model, hash, np.asarray(vectors[hash], dtype=np.float32).tobytes(), now) for hash in missing]
+            )
+            self.conn.executemany(
+                "UPDATE embeddings SET used = ? WHERE model = ? AND hash = ?",
+                [(now, model, hash) for hash in unique if hash not in missing]
+            )
+            self.size += len(missing)
+            if self.size > self.max_entries:
+                self._evict()
+            self.conn.commit()
+
+        return [vectors[hash] for hash in hashes]
+
+    def _evict(self):
+        """按最近使用时间删除超出容量的条目，调用时需要持有锁"""
+        self.size = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = self.size - self.max_entries
+        if excess > 0:
+            self.conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY used LIMIT ?)",
+                (excess,)
+            )
+            self.size -= excess
+
+    def gc(self, referenced: dict[str, set[str]] = None):
+        """清理缓存，referenced 为每个模型当前仍被引用的片段哈希，不在其中的条目会被删除；之后按容量淘汰最久未使用的条目"""
+        if self.conn is None:
+            return
+        with self.lock:
+            if referenced is not None:
+                self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS referenced (model TEXT, hash TEXT)")
+                self.conn.execute("DELETE FROM referenced")
+                self.conn.executemany(
+                    "INSERT INTO referenced (model, hash) VALUES (?, ?)",
+                    [(model, hash) for model, hashes in referenced.items() for hash in hashes]
+                )
+                self.conn.execute(
+                    "DELETE FROM embeddings WHERE NOT EXISTS "
+                    "(SELECT 1 FROM referenced r WHERE r.model = embeddings.model AND r.hash = embeddings.hash)"
+                )
+                self.conn.execute("DELETE FROM referenced")
+            self._evict()
+            self.conn.commit()
+
+    def stats(self) -> dict:
+        if self.conn is None:
+            return { "enabled": False }
+        with self.lock:
+            return {
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses
+            }
@@ -0,0 +1,188 @@
+import os
+import mmap
+import threading
+import numpy as np
+from langchain.schema import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+class InternTable:
+    """只追加的取值表，相同的值（文档路径、代码语言）只保存一份，所有文档库共享"""
+
+    def __init__(self):
+        self.values: list = []
+        self.index: dict = {}
+        self.lock = threading.Lock()
+
+    def intern(self, value) -> int:
+        """返回值在表中的序号，值为 None 时返回 -1"""
+        if value is None:
+            return -1
+        i = self.index.get(value)
+        if i is None:
+            with self.lock:
+                i = self.index.get(value)
+                if i is None:
+                    i = len(self.values)
+                    self.values.append(value)
+                    self.index[value] = i
+        return i
+
+    def get(self, i: int):
+        return None if i < 0 else self.values[i]
+
+SOURCES = InternTable()
+"""片段来源（文档路径）表"""
+LANGUAGES = InternTable()
+"""代码语言表"""
+
+class ChunkRecord:
+    """一个片段的紧凑记录，文本保存在共享的 UTF-8 分段中，来源与语言只保存在表中的序号"""
+    __slots__ = ("segment", "start", "end", "source", "language", "is_code", "extra")
+
+    def __init__(self, segment, start: int, end: int, source: int, language: int, is_code: bool, extra: dict):
+        # 片段文本所在的分段，可以是 bytes 或内存映射的文件
+        self.segment = segment
+        self.start = start
+        self.end = end
+        self.source = source
+        self.language = language
+        self.is_code = is_code
+        # 其余的元数据，没有时为 None
+        self.extra = extra
+
+    def text(self) -> str:
+        return self.segment[self.start:self.end].decode("utf-8")
+
+    def metadata(self) -> dict:
+        metadata = {}
+        if self.source >= 0:
+            metadata["source"] = SOURCES.get(self.source)
+        if self.language >= 0:
+            metadata["code_language"] = LANGUAGES.get(self.language)
+        if self.is_code is not None:
+            metadata["is_code"] = self.is_code
+        if self.extra:
+            metadata.update(self.extra)
+        return metadata
+
+def make_record(segment, start: int, end: int, metadata: dict) -> ChunkRecord:
+    extra = { key: value for key, value in metadata.items() if key not in ("source", "code_language", "is_code") }
+    return ChunkRecord(
+        segment, start, end,
+        SOURCES.intern(metadata.get("source")), LANGUAGES.intern(metadata.get("code_language")),
+        metadata.get("is_code"), extra or None
+    )
+
+class CompactDocstore(Docstore, AddableMixin):
+    """紧凑的片段存储，代替为每个片段保存一个 Document 的 InMemoryDocstore
+
+    每次添加的一批片段编码为一个连续的 UTF-8 分段，读取的缓存整体作为一个分段（可以内存映射），
+    只有检索返回的片段才会构建 Document。记录创建后不会修改，复制文档库时新旧文档库共享记录与分段。
+    """
+    records: dict[str, ChunkRecord]
+
+    def __init__(self, records: dict[str, ChunkRecord] = None):
+        self.records = records if records is not None else {}
+
+    @classmethod
+    def from_docstore(cls, docstore: Docstore, ids: list[str]) -> "CompactDocstore":
+        """复制一个文档库用于修改，其他类型的文档库（旧版缓存）会转换为紧凑格式"""
+        if isinstance(docstore, CompactDocstore):
+            return CompactDocstore(dict(docstore.records))
+        compact = CompactDocstore()
+        compact.add({ id: docstore.search(id) for id in ids })
+        return compact
+
+    def add(self, texts: dict[str, Document]) -> None:
+        overlapping = set(texts).intersection(self.records)
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        encoded = [doc.page_content.encode("utf-8") for doc in texts.values()]
+        segment = b"".join(encoded)
+        start = 0
+        for (id, doc), data in zip(texts.items(), encoded):
+            self.records[id] = make_record(segment, start, start + len(data), doc.metadata)
+            start += len(data)
+
+    def extend(self, other: Docstore, ids: list[str]):
+        """从另一个文档库添加片段，紧凑文档库之间直接共享记录，不需要构建 Document"""
+        if not isinstance(other, CompactDocstore):
+            self.add({ id: other.search(id) for id in ids })
+            return
+        overlapping = set(ids).intersection(self.records)
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        for id in ids:
+            self.records[id] = other.records[id]
+
+    def delete(self, ids: list) -> None:
+        missing = set(ids).difference(self.records)
+        if missing:
+            raise ValueError(f"Tried to delete ids that does not exist: {missing}")
+        for id in ids:
+            del self.records[id]
+
+    def search(self, search: str) -> Document | str:
+        record = self.records.get(search)
+        if record is None:
+            return f"ID {search} not found."
+        return Document(id=search, page_content=record.text(), metadata=record.metadata())
+
+    def text(self, id: str) -> str:
+        """只读取片段文本，不构建 Document"""
+        return self.records[id].text()
+
+    def write(self, ids: list[str], path: str) -> dict:
+        """按 ids 的顺序将片段文本写入 path，返回需要另外保存的偏移、表序号与其余元数据"""
+        records = [self.records[id] for id in ids]
+        offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        with open(path, 'wb') as f:
+            for i, record in enumerate(records):
+                f.write(record.segment[record.start:record.end])
+                offsets[i + 1] = offsets[i] + record.end - record.start
+        return {
+            "ids": ids,
+            "offsets": offsets,
+            "sources": list(SOURCES.values),
+            "source_index": np.array([record.source for record in records], dtype=np.int32),
+            "languages": list(LANGUAGES.values),
+            "language_index": np.array([record.language for record in records], dtype=np.int32),
+            "is_code": np.array([-1 if record.is_code is None else int(record.is_code) for record in records], dtype=np.int8),
+            "extras": [record.extra for record in records]
+        }
+
+    @classmethod
+    def read(cls, data: dict, path: str, use_mmap=True) -> "CompactDocstore":
+        """读取 write 保存的片段，use_mmap 为 True 时文本以内存映射方式读取，只有用到的片段会载入内存"""
+        with open(path, 'rb') as f:
+            if use_mmap and os.fstat(f.fileno()).st_size > 0:
+                segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                segment = f.read()
+
+        offsets = data["offsets"].tolist()
+        if offsets[-1] != len(segment):
+            raise ValueError(f"Text file {path} does not match the docstore.")
+
+        # 保存时的表序号换成当前进程中的表序号，末尾的 -1 对应保存时的 -1（没有该元数据）
+        sources = np.array([SOURCES.intern(value) for value in data["sources"]] + [-1], dtype=np.int32)
+        languages = np.array([LANGUAGES.intern(value) for value in data["languages"]] + [-1], dtype=np.int32)
+        is_code = [None if flag < 0 else bool(flag) for flag in data["is_code"].tolist()]
+        records = {
+            id: ChunkRecord(segment, start, end, source, language, flag, extra)
+            for id, start, end, source, language, flag, extra in zip(
+                data["ids"], offsets[:-1], offsets[1:],
+                sources[data["source_index"]].tolist(), languages[data["language_index"]].tolist(),
+                is_code, data["extras"]
+            )
+        }
+        return cls(records)
+
+    def stats(self) -> dict:
+        segments = { id(record.segment): record.segment for record in self.records.values() }
+        return {
+            "chunks": len(self.records),
+            "text_bytes": sum(record.end - record.start for record in self.records.values()),
+            "segment_bytes": sum(len(segment) for segment in segments.values()),
+            "mapped": any(isinstance(segment, mmap.mmap) for segment in segments.values())
+        }
@@ -0,0 +1,108 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable
+from langchain_core.embeddings import Embeddings
+
+class MicroBatcher:
+    """将一小段时间内到达的请求合并为一批处理，每个请求会等待并取回自己的结果"""
+    func: Callable[[list], list]
+    """批处理函数，输入与输出一一对应"""
+    window: float = 0.005
+    """收集一批请求的最长等待时间（秒）"""
+    max_batch_size: int = 16
+
+    def __init__(self, func: Callable[[list], list], window_ms=5, max_batch_size=16, name="micro-batcher"):
+        self.func = func
+        self.window = max(0, window_ms) / 1000
+        self.max_batch_size = max(1, max_batch_size)
+        self.queue: queue.Queue[tuple[object, Future, float]] = queue.Queue()
+        self.lock = threading.Lock()
+
+        self.batches = 0
+        self.items = 0
+        self.max_batch = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        """提交一个请求，阻塞直至所在批次处理完毕"""
+        future = Future()
+        self.queue.put((item, future, time.perf_counter()))
+        return future.result()
+
+    def collect(self) -> list[tuple[object, Future, float]]:
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining <= 0:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            start = time.perf_counter()
+
+            with self.lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.max_batch = max(self.max_batch, len(batch))
+                for _, _, enqueued in batch:
+                    wait = start - enqueued
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+
+            try:
+                results = self.func([item for item, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "avg_batch_size": self.items / self.batches if self.batches else 0,
+                "max_batch_size": self.max_batch,
+                "avg_queue_wait_ms": self.total_wait / self.items * 1000 if self.items else 0,
+                "max_queue_wait_ms": self.max_wait * 1000
+            }
+
+class BatchedEmbeddings(Embeddings):
+    """在嵌入模型前加一层调度，并发到达的提问会合并为一次 embed_documents 调用"""
+    model: Embeddings
+    model_name: str
+
+    def __init__(self, model: Embeddings, window_ms=5, max_batch_size=16):
+        self.model = model
+        self.model_name = getattr(model, "model_name", type(model).__name__)
+        self.batcher = MicroBatcher(
+            model.embed_documents, window_ms, max_batch_size,
+            name=f"embed-batcher-{self.model_name}"
+        )
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        # 文档本身就是成批嵌入的，直接交给模型
+        return self.model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.batcher.submit(text)
+
+    def stats(self) -> dict:
+        return self.batcher.stats()
@@ -0,0 +1,67 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from .cache import normalize_query
+
+class SearchExecutor:
+    """在独立线程池中执行检索，避免嵌入推理与向量检索阻塞机器人的事件循环"""
+    pool: ThreadPoolExecutor
+    search: Callable[[str], list]
+
+    max_concurrency: int = 8
+    """同时进行的检索数量上限"""
+    timeout: float = 15
+    """单次检索的超时时间（秒），超时后调用方应退回不参考文档的提问"""
+
+    inflight: dict[str, asyncio.Future]
+    """正在进行中的检索，相同的提问会合并为一次检索"""
+
+    def __init__(self, search: Callable[[str], list], workers=4, max_concurrency=8, timeout=15):
+        self.search = search
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="rag-search")
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self.inflight = dict()
+        self.semaphore: asyncio.Semaphore = None
+
+        self.merged = 0
+        self.timeouts = 0
+
+    async def _run(self, query: str):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pool, self.search, query)
+
+    async def run(self, query: str) -> list:
+        """异步执行一次检索，超时会抛出 asyncio.TimeoutError"""
+        key = normalize_query(query)
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(query))
+            self.inflight[key] = task
+
+            def done(_):
+                if self.inflight.get(key) is task:
+                    self.inflight.pop(key)
+            task.add_done_callback(done)
+        else:
+            self.merged += 1
+
+        try:
+            # shield 保证一个等待方超时不会取消其他等待方共享的检索
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    def stats(self) -> dict:
+        return {
+            "inflight": len(self.inflight),
+            "merged": self.merged,
+            "timeouts": self.timeouts
+        }
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -1,44 +1,150 @@
 import os
+import math
+import time
+import threading
 import torch
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
+from ..cache import LRUCache, normalize_query
+from ..embedder import MicroBatcher
 
 class Classification:
     config: object = None
+    batcher: MicroBatcher = None
+    """合并并发提问的批处理调度器，并发到达的提问只做一次前向推理"""
+    cache: LRUCache = None
+    """分类结果缓存，键为规范化后的提问，值为 (是否需要文档, 代码权重)"""
+    session: object = None
+    """配置了 onnx_path 时使用的 onnxruntime 推理会话，否则为 None"""
     
     def __init__(self, root: str, config: object):
         self.config = config
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.warmup_ms = 0.0
+        self.backend = None
         if self.enabled():
             model_path = os.path.join(root, config.get("model_path"))
-            self.model = AutoModelForSequenceClassification.from_pretrained(model_path)
             self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+            self.load_model(root, model_path)
+            self.cache = LRUCache(config.get("cache_size", 1024))
+            self.batcher = MicroBatcher(
+                self.infer, config.get("batch_window_ms", 5), config.get("max_batch_size", 16),
+                name="classify-batcher"
+            )
+            self.warmup()
+    
+    def load_model(self, root: str, model_path: str):
+        """加载推理模型，配置了 onnx_path 且安装了 onnxruntime 时使用 ONNX 模型，否则使用 transformers 模型"""
+        threads = self.config.get("threads", 0)
+        onnx_path = self.config.get("onnx_path")
+        if onnx_path:
+            try:
+                import onnxruntime as ort
+                options = ort.SessionOptions()
+                if threads > 0:
+                    options.intra_op_num_threads = threads
+                self.session = ort.InferenceSession(
+                    os.path.join(root, onnx_path), options, providers=["CPUExecutionProvider"]
+                )
+                self.input_names = { i.name for i in self.session.get_inputs() }
+                self.backend = "onnx"
+                return
+            except ImportError:
+                print("Warn: onnxruntime is not installed, falling back to transformers model.")
+        
+        if threads > 0:
+            # torch 的线程数是进程级设置，会影响同一进程中的其他插件，因此默认不设置，只有显式配置 threads 时才修改
+            print(f"Warn: Setting torch threads to {threads} for the whole process (was {torch.get_num_threads()}).")
+            torch.set_num_threads(threads)
+        model = AutoModelForSequenceClassification.from_pretrained(model_path)
+        model.eval()
+        if self.config.get("quantize", True):
+            # 动态 int8 量化只作用于线性层，分类结果与全精度模型基本一致
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            self.backend = "torch-int8"
+        else:
+            self.backend = "torch"
+        self.model = model
+    
+    def warmup(self):
+        """加载后先推理一次，避免第一个提问承担初始化开销"""
+        start = time.perf_counter()
+        self.infer(["warm up"])
+        self.warmup_ms = (time.perf_counter() - start) * 1000
         
     def enabled(self):
         return self.config.get("enable", False)
     
-    def classify_and_sort(self, query: str, code: list, comment: list, text: list):
-        if not self.enabled():
-            return []
-        # 编码输入
-        inputs = self.tokenizer(query, return_tensors="pt", truncation=True, padding=True)
-        
-        # 获取模型输出
-        with torch.no_grad():
-            outputs = self.model(**inputs)
+    def logits(self, queries: list[str]) -> torch.Tensor:
+        if self.session is not None:
+            inputs = self.tokenizer(queries, return_tensors="np", truncation=True, padding=True)
+            feed = { name: value for name, value in inputs.items() if name in self.input_names }
+            return torch.from_numpy(self.session.run(None, feed)[0])
         
-        # 如果是分类任务，一般输出 logits
-        logits = outputs.logits
-        sigmoid_logits = torch.sigmoid(logits)
-        
-        value1 = sigmoid_logits[0, 0].item()
-        value2 = sigmoid_logits[0, 1].item()
+        inputs = self.tokenizer(queries, return_tensors="pt", truncation=True, padding=True)
+        with torch.inference_mode():
+            return self.model(**inputs).logits
+    
+    def infer(self, queries: list[str]) -> list[tuple[bool, float]]:
+        """批量推理，返回每个提问的 (是否需要文档, 代码权重)"""
+        sigmoid_logits = torch.sigmoid(self.logits(queries)).tolist()
+        threshold = self.config.get("need_doc_threshold")
         
         # 文本至少有 0.2 的权重
-        code_weight = value1 * 0.8
-        need_doc = value2 > self.config.get("need_doc_threshold")
+        return [(value2 > threshold, value1 * 0.8) for value1, value2, *_ in sigmoid_logits]
+    
+    def classify(self, query: str) -> tuple[bool, float]:
+        """判断提问是否需要参考文档，返回 (是否需要文档, 代码权重)"""
+        start = time.perf_counter()
+        normalized = normalize_query(query)
+        result = self.cache.get(normalized)
+        if result is None:
+            result = self.batcher.submit(normalized)
+            self.cache.put(normalized, result)
         
-        if not need_doc:
-            return []
+        latency = time.perf_counter() - start
+        with self.lock:
+            self.calls += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        return result
+    
+    def stats(self) -> dict:
+        """获取分类推理的统计信息，延迟包含缓存命中与批处理排队的时间"""
+        with self.lock:
+            stats = {
+                "backend": self.backend,
+                "calls": self.calls,
+                "avg_latency_ms": self.total_latency / self.calls * 1000 if self.calls else 0.0,
+                "max_latency_ms": self.max_latency * 1000,
+                "warmup_ms": self.warmup_ms
+            }
+        if self.enabled():
+            stats["cache"] = self.cache.stats()
+            stats["batch"] = self.batcher.stats()
+        return stats
+    
+    def store_k(self, code_weight: float) -> tuple[int, int, int]:
+        """根据代码权重决定 (文本, 代码, 注释) 三个数据库各检索多少个片段
+
+        权重最高的数据库检索 max_k 个，其余按权重比例减少，权重低于 min_store_weight 的数据库不检索。
+        """
+        max_k = self.config.get("max_k", 6)
+        min_weight = self.config.get("min_store_weight", 0.1)
+        text_weight = 1 - code_weight
+        top = max(code_weight, text_weight)
         
+        def k(weight: float) -> int:
+            if weight < min_weight:
+                return 0
+            return min(max_k, max(1, math.ceil(max_k * weight / top)))
+        
+        return k(text_weight), k(code_weight), k(code_weight)
+    
+    def sort(self, code: list, comment: list, text: list, code_weight: float):
+        """按代码权重对三个数据库的检索结果加权排序"""
         results: list[tuple] = []
         
         # 对 list1 中的每个元组乘以对应权重
@@ -58,5 +164,13 @@ class Classification:
             
         results_sorted = sorted(results, key=lambda x: x[1], reverse=True)
         
-        return results_sorted[:6]
-        
\ No newline at end of file
+        return results_sorted[:self.config.get("max_k", 6)]
+    
+    def classify_and_sort(self, query: str, code: list, comment: list, text: list):
+        if not self.enabled():
+            return []
+        need_doc, code_weight = self.classify(query)
+        if not need_doc:
+            return []
+        return self.sort(code, comment, text, code_weight)
+        
@@ -0,0 +1,150 @@
+import os
+import traceback
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from tqdm import tqdm
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import FAISS, DistanceStrategy
+from .loader import CodeAwareMDLoader, CodeLoader, read_document
+from .splitter import DocumentSplitter
+from .docstore import CompactDocstore
+
+_worker_splitter: DocumentSplitter = None
+"""子进程中使用的分割器，每个进程只创建一次"""
+
+def _init_worker(splitter_config: dict):
+    global _worker_splitter
+    _worker_splitter = DocumentSplitter(**splitter_config)
+
+def load_and_split(doc_path: str, mode: str, splitter: DocumentSplitter) -> tuple[list[Document], dict]:
+    """加载并分割一个文档，非 md 文档会使用 code-only 模式，返回片段与文档指纹（哈希与文件状态）"""
+    path = Path(doc_path)
+    content, fingerprint = read_document(doc_path)
+    if path.suffix == ".md":
+        docs = splitter.split_documents(CodeAwareMDLoader(path, content).load(), mode)
+    else:
+        docs = splitter.split_documents(CodeLoader(path, content).load(), "code-only")
+    return docs, fingerprint
+
+def _split_in_worker(doc_path: str, mode: str) -> tuple[list[Document], dict]:
+    return load_and_split(doc_path, mode, _worker_splitter)
+
+class IngestEngine:
+    """文档索引引擎，在进程池中并行加载、分割文档，再跨文档批量嵌入"""
+    processes: int = 0
+    """分割文档使用的进程数，0 表示使用全部核心"""
+    embed_batch_size: int = 128
+    """每次交给嵌入模型的片段数量"""
+
+    def __init__(self, parser, processes=0, embed_batch_size=128):
+        self.parser = parser
+        self.processes = processes if processes > 0 else (os.cpu_count() or 1)
+        self.embed_batch_size = max(1, embed_batch_size)
+        # 分割时进程中已经有批处理、文档监听与 SQLite 的线程，fork 出的子进程可能死锁而不是退出，
+        # 使用 forkserver（不支持时为 spawn）启动子进程，子进程异常时才能退回当前进程分割
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.mp_context = multiprocessing.get_context(start_method)
+
+    def split_all(self, items: list[tuple[str, str]]) -> list[tuple[str, list[Document], dict]]:
+        """分割全部文档，返回 (文档路径, 片段, 文档指纹) 列表，分割失败的文档会被跳过"""
+        splitter: DocumentSplitter = self.parser.splitter
+        results: list[tuple[str, list[Document], dict]] = []
+
+        def split_inline():
+            for path, mode in tqdm(items, desc="Splitting documents", leave=False):
+                try:
+                    results.append((path, *load_and_split(path, mode, splitter)))
+                except Exception as e:
+                    tqdm.write(f'Warn: Split document "{path}" failed. exception: {e}')
+                    traceback.print_exc()
+
+        workers = min(self.processes, len(items))
+        if workers <= 1:
+            split_inline()
+            return results
+
+        splitter_config = {
+            "code_context_length": splitter.code_context_length,
+            "chunk_size": splitter.chunk_size,
+            "chunk_overlap": splitter.chunk_overlap
+        }
+        try:
+            with ProcessPoolExecutor(
+                workers, mp_context=self.mp_context, initializer=_init_worker, initargs=(splitter_config,)
+            ) as pool:
+                futures = [(path, pool.submit(_split_in_worker, path, mode)) for path, mode in items]
+                for path, future in tqdm(futures, desc="Splitting documents", leave=False):
+                    try:
+                        results.append((path, *future.result()))
+                    except BrokenProcessPool:
+                        # 子进程异常退出时其余文档也会全部失败，交给下面整体退回当前进程
+                        raise
+                    except Exception as e:
+                        tqdm.write(f'Warn: Split document "{path}" failed. exception: {e}')
+        except Exception as e:
+            # 进程池不可用或子进程异常退出时退回当前进程分割
+            tqdm.write(f"Warn: Process pool unavailable, splitting documents in current process. exception: {e}")
+            results.clear()
+            split_inline()
+        return results
+
+    def embed(self, model: Embeddings, texts: list[str], desc: str) -> list[list[float]]:
+        """将片段按批次交给嵌入模型，嵌入缓存中已有的片段不会重新嵌入"""
+        def embed_batches(missing: list[str]) -> list[list[float]]:
+            vectors: list[list[float]] = []
+            batches = range(0, len(missing), self.embed_batch_size)
+            for start in tqdm(batches, desc=desc, leave=False, disable=len(batches) <= 1):
+                vectors.extend(model.embed_documents(missing[start:start + self.embed_batch_size]))
+            return vectors
+
+        model_name = getattr(model, "model_name", type(model).__name__)
+        return self.parser.embedding_cache.embed(model_name, texts, embed_batches)
+
+    def build_stores(self, chunks: list[tuple[list[Document], list[Document], list[Document]]]) -> list[tuple[FAISS, FAISS, FAISS]]:
+        """为每个文档构建 (文本, 代码, 注释) 三个数据库，同一模型的片段会跨文档合并为大批次嵌入"""
+        parser = self.parser
+        # 文本与注释都使用文本模型
+        groups = [
+            (parser.text_model, [text for text, _, _ in chunks] + [comment for _, _, comment in chunks], "Embedding text"),
+            (parser.code_model, [code for _, code, _ in chunks], "Embedding code")
+        ]
+        stores: list[list[FAISS]] = [[None, None, None] for _ in chunks]
+
+        for model, doc_lists, desc in groups:
+            texts = [doc.page_content for docs in doc_lists for doc in docs]
+            if not texts:
+                continue
+            vectors = self.embed(model, texts, desc)
+
+            offset = 0
+            for i, docs in enumerate(doc_lists):
+                if not docs:
+                    continue
+                doc_vectors = vectors[offset:offset + len(docs)]
+                offset += len(docs)
+                store = FAISS.from_embeddings(
+                    [(doc.page_content, vector) for doc, vector in zip(docs, doc_vectors)], model,
+                    metadatas=[doc.metadata for doc in docs], ids=[doc.id for doc in docs],
+                    distance_strategy=DistanceStrategy.COSINE, docstore=CompactDocstore()
+                )
+                # 前半部分是文本，后半部分是注释
+                if model is parser.code_model:
+                    stores[i][1] = store
+                elif i < len(chunks):
+                    stores[i][0] = store
+                else:
+                    stores[i - len(chunks)][2] = store
+
+        return [tuple(store) for store in stores]
+
+    def ingest_merged(self, items: list[tuple[str, str]]) -> tuple[list[tuple[str, dict]], tuple[FAISS, FAISS, FAISS]]:
+        """索引一批文档并直接合并为 (文本库, 代码库, 注释库)，返回成功索引的 (文档路径, 文档指纹) 列表与合并后的数据库"""
+        if not items:
+            return [], (None, None, None)
+        splitted = self.split_all(items)
+        chunks = [self.parser.split_chunks(docs, path) for path, docs, _ in splitted]
+        merged = tuple([doc for chunk in chunks for doc in chunk[i]] for i in range(3))
+        return [(path, fingerprint) for path, _, fingerprint in splitted], self.build_stores([merged])[0]
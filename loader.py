@@ -1,4 +1,6 @@
+import os
 import re
+import hashlib
 from tqdm import tqdm
 from pathlib import Path
 from langchain_community.document_loaders.base import BaseLoader
@@ -6,17 +8,42 @@ from langchain.schema import Document
 from typing import List
 from .splitter import languages_map
 
+def file_fingerprint(stat: os.stat_result) -> dict:
+    """文件状态指纹，修改时间、大小、inode 都未变化时可以认为文件没有修改"""
+    return { "mtime": stat.st_mtime_ns, "size": stat.st_size, "inode": stat.st_ino }
+
+def read_document(file_path: str) -> tuple[str, dict]:
+    """读取文档内容，同时计算哈希与文件状态指纹，加载、哈希、写入缓存只需读取一次文件"""
+    with open(file_path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        data = f.read()
+    # 与文本模式读取一致，统一换行符，保证哈希与之前的缓存兼容
+    content = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    return content, { "hash": hashlib.sha256(content.encode()).hexdigest(), **file_fingerprint(stat) }
+
+def hash_document(file_path: str, chunk_size=1 << 20) -> str:
+    """流式计算文档哈希，不会一次性读入整个文件"""
+    sha = hashlib.sha256()
+    with open(file_path, 'r', encoding='utf-8') as f:
+        while chunk := f.read(chunk_size):
+            sha.update(chunk.encode())
+    return sha.hexdigest()
+
 def extract_language(line: str) -> str:
     match = re.match(r"^```(\w+)", line.strip())
     return match.group(1) if match else ""
 
 class CodeAwareMDLoader(BaseLoader):
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, content: str = None):
         self.file_path = file_path
+        self.content = content
     
     def load(self) -> List[Document]:
-        with open(self.file_path, 'r', encoding='utf-8') as f:
-            md_content = f.read()
+        if self.content is not None:
+            md_content = self.content
+        else:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                md_content = f.read()
         
         line_data = md_content.splitlines()
         in_code = False
@@ -64,12 +91,16 @@ class CodeAwareMDLoader(BaseLoader):
         return docs
     
 class CodeLoader(BaseLoader):
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, content: str = None):
         self.file_path = file_path
+        self.content = content
         
     def load(self) -> List[Document]:
-        with open(self.file_path, 'r', encoding='utf-8') as f:
-            code_content = f.read()
+        if self.content is not None:
+            code_content = self.content
+        else:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                code_content = f.read()
             
         path = Path(self.file_path)
         ext = path.suffix[1:]
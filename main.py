@@ -1,7 +1,7 @@
 import json
 import os
+import asyncio
 from datetime import datetime
-from tqdm import tqdm
 from pkg.plugin.context import register, handler, llm_func, BasePlugin, APIHost, EventContext
 from pkg.plugin.events import *  # 导入事件类
 from .parse import DocumentParser
@@ -16,16 +16,10 @@ class LangBotPluginDocument(BasePlugin):
     def __init__(self, host: APIHost):
         print("=============== Loading LangBot Document Plugin ===============")
         os.makedirs(os.path.join(self.current_dir, "data"), exist_ok=True)
-        os.makedirs(os.path.join(self.current_dir, "data/text"), exist_ok=True)
-        os.makedirs(os.path.join(self.current_dir, "data/code"), exist_ok=True)
-        os.makedirs(os.path.join(self.current_dir, "data/comment"), exist_ok=True)
+        os.makedirs(os.path.join(self.current_dir, "data/index"), exist_ok=True)
         
-        indices_path = os.path.join(self.current_dir, "indices.json")
         log_path = os.path.join(self.current_dir, "user_queries.log")
         
-        if not os.path.exists(indices_path):
-            with open(indices_path, 'w') as f:
-                f.write("{}")
         if not os.path.exists(log_path):
             with open(log_path, 'w') as f:
                 pass
@@ -34,52 +28,46 @@ class LangBotPluginDocument(BasePlugin):
         
         with open(os.path.join(self.current_dir, "config.json"), 'r', encoding='utf-8') as file:
             data = json.load(file)
-        with open(indices_path, 'r', encoding='utf-8') as indices:
-            indices_cache = json.load(indices)
             
-        self.parser = DocumentParser(data, indices_cache, self.current_dir, indices_path)
+        self.parser = DocumentParser(data, self.current_dir)
         
         self.reference_prompt = data["reference_prompt"]
         self.question_prompt = data["question_prompt"]
         self.debug = data["debug"]
         self.log_queries = data["log_queries"]
+        self.indexing_notice = data.get("indexing_notice", "")
         
-        print("Fetching models...")
-        
-        self.parser.fetch_models()
-        
-        for path in tqdm(data["files"], desc="Loading and parsing documents"):
+        files: list[tuple[str, str]] = []
+        for path in data["files"]:
             if isinstance(path, str):
-                self.parser.load_document(os.path.join(self.current_dir, "docs", path), data["mode"])
+                files.append((os.path.join(self.current_dir, "docs", path), data["mode"]))
             else:
-                self.parser.load_document(os.path.join(self.current_dir, "docs", path["path"]), path["mode"])
-        
-        cache = self.parser.merge_documents()
+                files.append((os.path.join(self.current_dir, "docs", path["path"]), path["mode"]))
         
-        with open(indices_path, 'w', encoding='utf-8') as indices:
-            json.dump(cache, indices, ensure_ascii=False, indent=4)
-            
-        # 初始化加载完毕后再开始监听
-        self.parser.watcher.start()
+        # 模型加载与文档索引在后台进行，不阻塞 LangBot 启动，索引完成后才开始监听文档变化
+        self.parser.start(files)
 
-        print("=============== Loaded LangBot Document Plugin ===============")
+        print("=============== Loaded LangBot Document Plugin, indexing documents in background ===============")
 
     async def initialize(self):
         pass
     
-    def handle_RAG(self, message):
+    async def handle_RAG(self, message):
         print("Processing RAG")
-        docs = self.parser.search(message)
-        text = "\n---\n".join(
-            f"{doc.metadata.get('prev_context', '')}\n"
-            f"{doc.metadata.get('code', doc.page_content)}\n"
-            f"{doc.metadata.get('next_context', '')}"
-            for doc in docs
-        )
+        try:
+            docs = await self.parser.asearch(message)
+        except asyncio.TimeoutError:
+            # 检索超时，退回不参考文档的提问
+            print(f"Warn: Document retrieval timed out after {self.parser.executor.timeout}s, fallback to raw question.")
+            return ""
+        # 合并重叠片段、去掉重复文本，并限制在 token 预算内
+        packed = self.parser.packer.pack(docs)
+        if docs:
+            print(f"Packed {len(docs)} chunks into {packed.tokens} tokens, saved {packed.saved} tokens.")
 
-        return text
+        return packed.text
     
-    def handle_message(self, msg: str):
+    async def handle_message(self, msg: str):
         handled = msg.strip()
         
         if self.log_queries:
@@ -88,8 +76,11 @@ class LangBotPluginDocument(BasePlugin):
         
         if msg.startswith("*raw"):
             handled = f"{self.question_prompt}{msg[4:]}"
+        elif not self.parser.searchable():
+            # 索引缓存还没有读取完，不参考文档
+            handled = f"{self.question_prompt}{msg}"
         else:
-            context = self.handle_RAG(msg)
+            context = await self.handle_RAG(msg)
             if context.strip():
                 handled = f"{self.reference_prompt}\n{context}\n{self.question_prompt}{msg}"
             else:
@@ -97,10 +88,20 @@ class LangBotPluginDocument(BasePlugin):
             
         return handled
 
+    def reply_indexing(self, ctx: EventContext) -> bool:
+        """索引尚不能检索且配置了 indexing_notice 时，直接回复提示（可以包含进度），返回是否已经回复"""
+        if not self.indexing_notice or self.parser.searchable() or self.parser.progress.stage == "failed":
+            return False
+        ctx.add_return("reply", [self.parser.progress.render(self.indexing_notice)])
+        ctx.prevent_default()
+        return True
+
     @handler(PersonNormalMessageReceived)
     async def person_normal_message_received(self, ctx: EventContext):
+        if self.reply_indexing(ctx):
+            return
         msg = ctx.event.text_message.strip()
-        handled = self.handle_message(msg)
+        handled = await self.handle_message(msg)
         ctx.event.alter = handled
         if self.debug:
             print(handled)
@@ -108,11 +109,13 @@ class LangBotPluginDocument(BasePlugin):
 
     @handler(GroupNormalMessageReceived)
     async def group_normal_message_received(self, ctx: EventContext):
+        if self.reply_indexing(ctx):
+            return
         msg = ctx.event.text_message.strip()
-        handled = self.handle_message(msg)
+        handled = await self.handle_message(msg)
         ctx.event.alter = handled
         if self.debug:
             print(handled)
 
     def __del__(self):
-        self.parser.watcher.end()
+        self.parser.close()
@@ -0,0 +1,113 @@
+import os
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from collections.abc import MutableMapping
+
+class SQLiteMapping(MutableMapping):
+    """以字典方式访问的 SQLite 表，每次赋值或删除都会立即写入，值以 JSON 保存
+
+    注意取出的值是副本，修改后需要重新赋值才会写入。
+    """
+
+    def __init__(self, store: "MetadataStore", table: str, decode=lambda value: value):
+        self.store = store
+        self.table = table
+        self.decode = decode
+
+    def __getitem__(self, key: str):
+        with self.store.lock:
+            row = self.store.conn.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self.decode(json.loads(row[0]))
+
+    def __setitem__(self, key: str, value):
+        with self.store.transaction():
+            self.store.conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False))
+            )
+
+    def __delitem__(self, key: str):
+        with self.store.transaction():
+            cursor = self.store.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            if cursor.rowcount == 0:
+                raise KeyError(key)
+
+    def __iter__(self):
+        with self.store.lock:
+            keys = [row[0] for row in self.store.conn.execute(f"SELECT key FROM {self.table}")]
+        return iter(keys)
+
+    def __len__(self):
+        with self.store.lock:
+            return self.store.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+class MetadataStore:
+    """索引元数据存储，使用 WAL 模式的 SQLite
+
+    每个文档的更新只是一次小事务，不需要重写整个缓存文件，进程崩溃也不会损坏已经写入的数据。
+    """
+    VERSION = 1
+
+    documents: SQLiteMapping
+    """文档缓存信息，键为文档绝对路径，值包含内容哈希与文件状态"""
+    doc_ids: SQLiteMapping
+    """每个文档在三种数据库中的片段 id，键为文档相对于插件目录的路径"""
+
+    def __init__(self, path: str):
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.transaction():
+            self.conn.execute("CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS doc_ids (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.conn.execute(f"PRAGMA user_version={self.VERSION}")
+        self.documents = SQLiteMapping(self, "documents")
+        self.doc_ids = SQLiteMapping(self, "doc_ids", decode=tuple)
+
+    @contextmanager
+    def transaction(self):
+        """将多次写入合并为一个事务，可以嵌套，最外层结束时提交"""
+        with self.lock:
+            if self.depth == 0:
+                self.conn.execute("BEGIN")
+            self.depth += 1
+            try:
+                yield
+            except BaseException:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.conn.execute("ROLLBACK")
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                self.conn.execute("COMMIT")
+
+    def migrate(self, indices_path: str):
+        """从旧版 indices.json 导入元数据，导入后将其重命名，不会重复导入"""
+        if not os.path.exists(indices_path):
+            return
+        try:
+            with open(indices_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Warn: Failed to read {indices_path}, documents will be reindexed. exception: {e}")
+            cache = {}
+
+        # 没有 data 的是更早的缓存格式，无法沿用
+        if cache.get('data') is not None:
+            with self.transaction():
+                for path, entry in cache['data'].items():
+                    self.documents[path] = entry
+                for path, ids in cache.get('doc_ids', {}).items():
+                    self.doc_ids[path] = ids
+        os.replace(indices_path, f"{indices_path}.migrated")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
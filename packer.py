@@ -0,0 +1,209 @@
+import re
+import threading
+from typing import NamedTuple
+from langchain.schema import Document
+
+CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+"""按一个字符一个 token 估算的中日韩字符"""
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的 token 数，中日韩字符每个字算一个 token，其余字符每 4 个算一个 token"""
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def render_document(doc: Document) -> str:
+    """片段本身与上下文拼接后的文本，代码注释库的片段使用对应的代码"""
+    parts = (
+        doc.metadata.get('prev_context', ''),
+        doc.metadata.get('code', doc.page_content),
+        doc.metadata.get('next_context', '')
+    )
+    return "\n".join(part for part in parts if part)
+
+def overlap(a: str, b: str, min_overlap: int) -> int:
+    """a 的结尾与 b 的开头重叠的最长长度，重叠少于 min_overlap 个字符时返回 0"""
+    if len(b) < min_overlap:
+        return 0
+    probe = b[:min_overlap]
+    pos = a.find(probe, max(0, len(a) - len(b)))
+    while pos != -1:
+        # 最先找到的位置对应最长的重叠
+        if b.startswith(a[pos:]):
+            return len(a) - pos
+        pos = a.find(probe, pos + 1)
+    return 0
+
+def shingles(text: str, size=8) -> set[int]:
+    """规范化空白与大小写后，文本的字符 n-gram 集合，用于判断近似重复"""
+    text = re.sub(r"\s+", " ", text).strip().lower()
+    if len(text) <= size:
+        return { hash(text) }
+    return { hash(text[i:i + size]) for i in range(len(text) - size + 1) }
+
+class Span:
+    """同一来源中合并后的一段连续文本"""
+    __slots__ = ("source", "text", "rank", "count")
+
+    def __init__(self, source: str, text: str, rank: int):
+        self.source = source
+        self.text = text
+        # 合并进来的片段中最靠前的检索名次，决定填充预算的顺序
+        self.rank = rank
+        self.count = 1
+
+    def merge(self, text: str, min_overlap: int) -> bool:
+        """尝试把文本合并进这一段，包含、被包含或首尾重叠时合并并返回 True"""
+        if text in self.text:
+            pass
+        elif self.text in text:
+            self.text = text
+        elif (length := overlap(self.text, text, min_overlap)) > 0:
+            self.text += text[length:]
+        elif (length := overlap(text, self.text, min_overlap)) > 0:
+            self.text = text + self.text[length:]
+        else:
+            return False
+        self.count += 1
+        return True
+
+class PackedContext(NamedTuple):
+    text: str
+    raw_tokens: int
+    """不做合并去重时的 token 数"""
+    tokens: int
+    saved: int
+
+class ContextPacker:
+    """将检索到的片段打包为提示词中的参考文档
+
+    同一来源相邻或重叠的片段会合并为连续的一段，完全重复与近似重复的文本会被去掉，
+    之后按检索名次依次放入，直至达到 token 预算。
+    """
+    max_tokens: int = 2000
+    """参考文档的 token 预算，为 0 时不限制"""
+    min_overlap: int = 20
+    """首尾至少重叠这么多字符才视为相邻片段并合并"""
+    near_duplicate: float = 0.9
+    """与已放入的文本相似度（Jaccard）不低于此值时视为近似重复"""
+    separator: str = "\n---\n"
+
+    def __init__(self, config: dict = None):
+        config = config or {}
+        self.max_tokens = config.get("max_tokens", 2000)
+        self.min_overlap = max(1, config.get("min_overlap", 20))
+        self.near_duplicate = config.get("near_duplicate", 0.9)
+        self.lock = threading.Lock()
+
+        self.queries = 0
+        self.raw_tokens = 0
+        self.tokens = 0
+        self.merged = 0
+        self.duplicates = 0
+        self.over_budget = 0
+        self.last_saved = 0
+
+    def merge(self, docs: list[Document]) -> list[Span]:
+        """按检索名次合并同一来源的片段"""
+        spans: list[Span] = []
+        by_source: dict[str, list[Span]] = {}
+        for rank, doc in enumerate(docs):
+            text = render_document(doc)
+            if not text.strip():
+                continue
+            source = doc.metadata.get("source", "")
+            candidates = by_source.setdefault(source, [])
+            if any(span.merge(text, self.min_overlap) for span in candidates):
+                continue
+            span = Span(source, text, rank)
+            candidates.append(span)
+            spans.append(span)
+
+        # 合并后的段之间也可能相邻，例如先检索到第 1、3 段，之后才检索到第 2 段
+        for candidates in by_source.values():
+            changed = True
+            while changed:
+                changed = False
+                for i, span in enumerate(candidates):
+                    for other in candidates[i + 1:]:
+                        if span.merge(other.text, self.min_overlap):
+                            span.count += other.count - 1
+                            span.rank = min(span.rank, other.rank)
+                            candidates.remove(other)
+                            spans.remove(other)
+                            changed = True
+                            break
+                    if changed:
+                        break
+
+        return sorted(spans, key=lambda span: span.rank)
+
+    def truncate(self, text: str, budget: int) -> str:
+        """按字符比例截断文本，使其不超过 token 预算"""
+        while text and estimate_tokens(text) > budget:
+            text = text[:len(text) * budget // estimate_tokens(text)]
+        return text
+
+    def pack(self, docs: list[Document]) -> PackedContext:
+        """打包参考文档，返回打包后的文本与节省的 token 数"""
+        raw_tokens = estimate_tokens(self.separator.join(
+            f"{doc.metadata.get('prev_context', '')}\n"
+            f"{doc.metadata.get('code', doc.page_content)}\n"
+            f"{doc.metadata.get('next_context', '')}"
+            for doc in docs
+        ))
+        spans = self.merge(docs)
+
+        selected: list[str] = []
+        selected_shingles: list[set[int]] = []
+        used = 0
+        duplicates = 0
+        over_budget = 0
+        separator_tokens = estimate_tokens(self.separator)
+        for span in spans:
+            # 其他来源中完全相同的文本（例如复制到多个文档中的段落）也只保留一份
+            grams = shingles(span.text)
+            if any(span.text in text for text in selected) or any(
+                len(grams & other) >= self.near_duplicate * len(grams | other) for other in selected_shingles
+            ):
+                duplicates += 1
+                continue
+            cost = estimate_tokens(span.text) + (separator_tokens if selected else 0)
+            if self.max_tokens > 0 and used + cost > self.max_tokens:
+                # 放不下的段跳过，后面更短的段可能还放得下
+                over_budget += 1
+                continue
+            selected.append(span.text)
+            selected_shingles.append(grams)
+            used += cost
+
+        if not selected and spans:
+            # 排名第一的段本身就超出预算时，截断后放入
+            selected.append(self.truncate(spans[0].text, self.max_tokens))
+
+        text = self.separator.join(selected)
+        tokens = estimate_tokens(text)
+        saved = max(0, raw_tokens - tokens)
+        with self.lock:
+            self.queries += 1
+            self.raw_tokens += raw_tokens
+            self.tokens += tokens
+            self.merged += sum(span.count - 1 for span in spans)
+            self.duplicates += duplicates
+            self.over_budget += over_budget
+            self.last_saved = saved
+        return PackedContext(text, raw_tokens, tokens, saved)
+
+    def stats(self) -> dict:
+        with self.lock:
+            saved = max(0, self.raw_tokens - self.tokens)
+            return {
+                "queries": self.queries,
+                "raw_tokens": self.raw_tokens,
+                "tokens": self.tokens,
+                "saved_tokens": saved,
+                "last_saved_tokens": self.last_saved,
+                "avg_saved_tokens": saved / self.queries if self.queries else 0.0,
+                "merged": self.merged,
+                "duplicates": self.duplicates,
+                "over_budget": self.over_budget
+            }
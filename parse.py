@@ -1,17 +1,32 @@
-import hashlib
 import os
+import time
+import asyncio
+import threading
 import traceback
 import json
 import shutil
+import numpy as np
 from tqdm import tqdm
-from pathlib import Path
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain.schema import Document
 from langchain_community.vectorstores import FAISS, DistanceStrategy
-from .loader import CodeAwareMDLoader, CodeLoader
 from .splitter import DocumentSplitter
 from .retriever import HybridRetriever
 from .watcher import DocumentWatcher
+from .executor import SearchExecutor
+from .embedder import BatchedEmbeddings
+from .cache import ResultCache, EmbeddingCache, normalize_query, content_hash
+from .ingest import IngestEngine
+from .packer import ContextPacker
+from .progress import IndexProgress
+from .docstore import CompactDocstore
+from .loader import file_fingerprint, hash_document
+from .store import (
+    IndexStorage, IndexSnapshot, STORE_NAMES, clone_store, remove_positions, empty_delta, docstore_positions,
+    DRIFT_SAMPLES, merge_stores, index_spec, index_type, index_compression, index_projection, index_vectors, index_bytes,
+    is_lossless, is_exact, needs_rebuild, build_index, tune_index, recall_at_k, projection_error
+)
+from .metadata import MetadataStore, SQLiteMapping
 from .extensions.classification import Classification
 
 def is_path_in_directory(path, directory):
@@ -20,29 +35,48 @@ def is_path_in_directory(path, directory):
     return common_path == os.path.abspath(directory)
 
 class DocumentParser:
-    text_model: HuggingFaceEmbeddings = None
-    code_model: HuggingFaceEmbeddings = None
+    text_model: BatchedEmbeddings = None
+    code_model: BatchedEmbeddings = None
     
     splitter: DocumentSplitter = None
     docs: list[Document] = []
     
-    text_store: FAISS = None
-    code_store: FAISS = None
-    code_comment_store: FAISS = None
+    snapshot: IndexSnapshot = IndexSnapshot(None, None, None)
+    """当前发布的数据库快照"""
     
     retriever: HybridRetriever = None
+    storage: IndexStorage = None
+    """合并后的索引缓存"""
+    ingest: IngestEngine = None
+    """文档索引引擎"""
+    executor: SearchExecutor = None
+    """异步检索使用的线程池"""
+    result_cache: ResultCache = None
+    """检索结果缓存"""
+    embedding_cache: EmbeddingCache = None
+    """片段嵌入缓存"""
+    packer: ContextPacker = None
+    """参考文档打包器"""
+    progress: IndexProgress = None
+    """启动索引的进度与就绪状态"""
     
     root_path: str = None
-    indices_path: str = None
     config: object = None
-    indices_cache: dict[str, object] = None
-    doc_ids: dict[str, tuple[list[str], list[str], list[str]]] = dict()
+    config_dirty: bool = False
+    """配置中的文档列表是否有变化，需要写回 config.json"""
+    index_stats: dict[str, dict]
+    """近似、压缩或降维索引的统计信息：召回率（recall）、大小（bytes）、降维丢失的方差占比（projection_error）"""
+    metadata: MetadataStore = None
+    """索引元数据存储"""
+    documents: SQLiteMapping = None
+    """文档缓存信息，键为文档绝对路径"""
+    doc_ids: SQLiteMapping = None
+    """每个文档的片段 id，键为文档相对于插件目录的路径"""
     doc_text_indices: list[FAISS] = list()
     doc_code_indices: list[FAISS] = list()
     doc_comment_indices: list[FAISS] = list()
     
     deleted_docs: set[str] = set()
-    max_id: int = 0
     
     from_cache: int = 0
     modified: int = 0
@@ -50,66 +84,135 @@ class DocumentParser:
     indexed: int = 0
     
     watcher: DocumentWatcher
+    stats_task: asyncio.Future = None
+    """定期输出统计信息的任务"""
     
-    def __init__(self, config, indices_cache: dict[str, object], root: str, indices_path: str):
+    def __init__(self, config, root: str):
         for i, path in enumerate(config['files']):
             config['files'][i] = os.path.normpath(path)
         
         self.config = config
-        self.indices_cache = indices_cache
-        self.indices_path = indices_path
         
-        # 检查索引缓存的格式
-        self.check_indices_cache()
-        self.doc_ids = self.indices_cache['doc_ids']
+        # 元数据保存在 SQLite 中，旧版的 indices.json 会自动导入
+        self.metadata = MetadataStore(os.path.join(root, 'data', 'metadata.db'))
+        self.metadata.migrate(os.path.join(root, 'indices.json'))
+        self.documents = self.metadata.documents
+        self.doc_ids = self.metadata.doc_ids
         
         self.root_path = root
         self.deleted_docs = { os.path.join(root, 'docs', path) for path in config["files"] }
-        if len(self.indices_cache['data']) == 0:
-            self.max_id = 0
-        else:
-            self.max_id = max([int(index["id"]) for index in self.indices_cache['data'].values()])
+        self.storage = IndexStorage(os.path.join(root, 'data', 'index'), config.get("index", {}).get("mmap_text", True))
+        self.index_stats = {}
+        # 保护快照的修改与发布，重建索引与后台合并只在读取和发布快照时持有，检索不需要这个锁
+        self.index_lock = threading.Lock()
+        self.compactions = 0
+        self.last_compaction = 0.0
+        self.total_compaction = 0.0
+        self.compacting = False
+        # 后台合并期间重建索引的修改，合并完成后重新应用到新的数据库上，没有合并时为 None
+        self.compaction_journal: list[tuple] = None
+        # 正在重建索引、元数据已经修改但片段还没有发布的文档及其旧片段 id
+        self.unpublished: dict[str, tuple] = {}
         self.splitter = DocumentSplitter(
             code_context_length=config["code_context_length"],
             chunk_size=config["chunk_size"],
             chunk_overlap=config["chunk_overlap"]
         )
-        self.watcher = DocumentWatcher(root, os.path.join(root, 'docs'), self)
-        self.clear_cache()
-        
-    def check_indices_cache(self):
-        cache = self.indices_cache
-        
-        if cache.get('data') is None:
-            # 如果 data 是 None 的话，说明是旧版缓存，但是由于新版更改了内容，没办法沿用旧版缓存，因此直接删除
-            cache = dict()
-            cache['data'] = dict()
-            cache['doc_ids'] = dict()
-        
-        # 给缓存加个版本信息，方便后续更新
-        cache['version'] = 1
-        self.indices_cache = cache
+        ingest_config = config.get("ingest", {})
+        self.ingest = IngestEngine(self, ingest_config.get("processes", 0), ingest_config.get("embed_batch_size", 128))
+        self.watcher = DocumentWatcher(root, os.path.join(root, 'docs'), self, config.get("watcher", {}))
+        search_config = config.get("search", {})
+        self.executor = SearchExecutor(
+            self.search,
+            workers=search_config.get("workers", 4),
+            max_concurrency=search_config.get("max_concurrency", 8),
+            timeout=search_config.get("timeout", 15)
+        )
+        cache_config = config.get("cache", {})
+        self.result_cache = ResultCache(cache_config.get("result_size", 256), cache_config.get("result_ttl", 600))
+        self.embedding_cache = EmbeddingCache(
+            os.path.join(root, 'data', 'embeddings.db'), cache_config.get("embedding_max_entries", 200000)
+        )
+        self.packer = ContextPacker(config.get("context", {}))
+        self.progress = IndexProgress()
         
-    def clear_cache(self):
-        """清理多余的缓存"""
-        code_cache = os.path.join(self.root_path, 'data', 'code')
-        comment_cache = os.path.join(self.root_path, 'data', 'comment')
-        text_cache = os.path.join(self.root_path, 'data', 'text')
-        ids = [f'doc_{index["id"]}' for index in self.indices_cache['data'].values()]
+    @property
+    def text_store(self) -> FAISS:
+        return self.snapshot.text_store
+    
+    @property
+    def code_store(self) -> FAISS:
+        return self.snapshot.code_store
+    
+    @property
+    def code_comment_store(self) -> FAISS:
+        return self.snapshot.code_comment_store
+    
+    @property
+    def generation(self) -> int:
+        """索引版本号，每次重建索引后递增，用于使检索结果缓存失效"""
+        return self.snapshot.generation
+    
+    def start(self, files: list[tuple[str, str]]):
+        """在后台线程中加载模型并索引全部文档，不阻塞插件加载，进度见 progress"""
+        self.startup_thread = threading.Thread(target=self.startup, args=(files,), name="rag-startup", daemon=True)
+        self.startup_thread.start()
+    
+    def startup(self, files: list[tuple[str, str]]):
+        """启动索引：读取缓存后立即发布快照，之后每索引完一批文档发布一次，全部完成后合并、写入缓存并开始监听文档变化"""
+        try:
+            print("Fetching models...")
+            self.fetch_models()
+            self.create_retriever()
+            
+            self.progress.begin("loading", len(files))
+            # 元数据按阶段分别提交，不在整个启动过程中占用事务
+            with self.metadata.transaction():
+                to_index = self.load_documents(files)
+            
+            self.progress.begin("indexing", len(to_index))
+            self.index_documents(to_index)
+            
+            self.progress.begin("merging")
+            with self.metadata.transaction():
+                self.merge_documents()
+        except Exception as e:
+            print(f"Loading documents failed. exception: {e}")
+            traceback.print_exc()
+            self.progress.fail(e)
+            return
         
-        to_delete = list()
-        for code in os.listdir(code_cache):
-            if not code in ids:
-                to_delete.append(os.path.join(code_cache, code))
-        for comment in os.listdir(comment_cache):
-            if not comment in ids:
-                to_delete.append(os.path.join(comment_cache, comment))
-        for text in os.listdir(text_cache):
-            if not text in ids:
-                to_delete.append(os.path.join(text_cache, text))
-                
-        for path in to_delete:
-            shutil.rmtree(path)
+        # 初始化加载完毕后再开始监听
+        self.watcher.start()
+        interval = self.config.get("stats_interval", 600)
+        if interval > 0:
+            self.stats_task = asyncio.run_coroutine_threadsafe(self.report_stats(interval), self.watcher.loop)
+        self.progress.finish()
+        print(f"✅ Document index ready in {self.progress.stats()['elapsed_seconds']:.1f}s.")
+    
+    def searchable(self) -> bool:
+        """是否已经发布过可以检索的快照，启动索引完成之前检索的是已经索引的部分文档"""
+        # 冷启动时读取缓存后发布的快照是空的，至少索引完一批文档后才算可以检索；全部完成后即使没有片段也可以检索
+        return (
+            self.retriever is not None and self.progress.searchable()
+            and (self.progress.stage == "ready" or self.snapshot.chunks() > 0)
+        )
+    
+    def clear_legacy_cache(self):
+        """合并后的索引写入后，删除旧版按文档保存的缓存"""
+        for name in ('text', 'code', 'comment'):
+            legacy = os.path.join(self.root_path, 'data', name)
+            if os.path.exists(legacy):
+                shutil.rmtree(legacy)
+        for path, indices in self.documents.items():
+            if 'id' not in indices:
+                continue
+            for key in ('text_path', 'code_path', 'comment_path'):
+                legacy = indices.pop(key, None)
+                if legacy and os.path.exists(legacy):
+                    shutil.rmtree(legacy)
+            indices.pop('id')
+            self.documents[path] = indices
     
     def fetch_models(self):
         """根据配置信息获取需要的模型"""
@@ -133,15 +236,22 @@ class DocumentParser:
         elif not need_text and need_code:
             print("Using code model to parse documents.")
             
-        # 加载模型，暂时两个模型都加载，之后再优化为按需加载
+        # 加载模型，提问的嵌入会经过批处理调度，合并并发到达的提问
+        embedding_config = self.config.get("embedding", {})
+        window_ms = embedding_config.get("batch_window_ms", 5)
+        max_batch_size = embedding_config.get("max_batch_size", 16)
         if need_text:
-            self.text_model = HuggingFaceEmbeddings(model_name=self.config["text_model"])
+            self.text_model = BatchedEmbeddings(
+                HuggingFaceEmbeddings(model_name=self.config["text_model"]), window_ms, max_batch_size
+            )
         if need_code:
-            self.code_model = HuggingFaceEmbeddings(model_name=self.config["code_model"])
+            self.code_model = BatchedEmbeddings(
+                HuggingFaceEmbeddings(model_name=self.config["code_model"]), window_ms, max_batch_size
+            )
             
     def check_cache(self, doc_path: str) -> bool:
         """检查一个文档的缓存是否存在，以及是否需要重新索引"""
-        indices = self.indices_cache['data'].get(doc_path)
+        indices = self.documents.get(doc_path)
         
         if not indices:
             self.new_doc += 1
@@ -150,224 +260,527 @@ class DocumentParser:
         if not os.path.exists(doc_path):
             return False
         
-        with open(doc_path, 'r', encoding='utf-8') as doc:
-            file_hash = hashlib.sha256(doc.read().encode()).hexdigest()
-        
-        if file_hash == indices["hash"]:
-            self.from_cache += 1
+        # 是否真的使用缓存还要看合并后的索引中有没有这个文档，由调用方计入 from_cache
+        if self.is_unchanged(doc_path):
             return True
         
         self.modified += 1
         return False
     
-    def cache_index(self, doc_path: str, text_index: FAISS, code_index: FAISS, comment_index: FAISS):
-        """将一个索引写入缓存"""
+    def is_unchanged(self, doc_path: str) -> bool:
+        """判断文档内容是否与缓存一致，没有缓存或文件不存在时返回 False"""
+        indices = self.documents.get(doc_path)
+        if not indices or not os.path.exists(doc_path):
+            return False
         
-        indices = self.indices_cache['data'].get(doc_path)
-        if indices:
-            index_id = indices["id"]
-        else:
-            self.max_id += 1
-            index_id = self.max_id
-            
-        text_path = os.path.join(self.root_path, "data\\text", f"doc_{index_id}")
-        code_path = os.path.join(self.root_path, "data\\code", f"doc_{index_id}")
-        comment_path = os.path.join(self.root_path, "data\\comment", f"doc_{index_id}")
+        # 修改时间、大小、inode 都没变时不需要计算哈希
+        fingerprint = file_fingerprint(os.stat(doc_path))
+        if all(indices.get(key) == value for key, value in fingerprint.items()):
+            return True
         
-        with open(doc_path, 'r', encoding='utf-8') as doc:
-            file_hash = hashlib.sha256(doc.read().encode()).hexdigest()
+        if hash_document(doc_path) == indices["hash"]:
+            # 内容没有变化（例如仅 touch），更新文件状态，下次启动即可跳过哈希
+            self.documents[doc_path] = { **indices, **fingerprint }
+            return True
+        return False
+    
+    def cache_index(self, doc_path: str, fingerprint: dict):
+        """记录一个文档的缓存信息（内容哈希与文件状态），向量本身保存在合并后的索引中"""
+        self.documents[doc_path] = dict(fingerprint)
             
-        self.indices_cache['data'][doc_path] = {
-            "text_path": text_path if text_index else None,
-            "comment_path": comment_path if comment_index else None,
-            "code_path": code_path if code_index else None,
-            "id": str(index_id),
-            "hash": file_hash
-        }
+    def load_legacy_document(self, doc_path: str):
+        """从旧版按文档保存的缓存加载一个文档的数据库，用于迁移到合并后的索引"""
+        indices = self.documents.get(doc_path)
+        text = None
+        code = None
+        comment = None
+        if indices["text_path"] and os.path.exists(indices["text_path"]):
+            text = FAISS.load_local(
+                indices["text_path"], self.text_model, "index", allow_dangerous_deserialization=True,
+                distance_strategy=DistanceStrategy.COSINE
+            )
+            self.doc_text_indices.append(text)
+        if indices["code_path"] and os.path.exists(indices["code_path"]):
+            code = FAISS.load_local(
+                indices["code_path"], self.code_model, "index", allow_dangerous_deserialization=True,
+                distance_strategy=DistanceStrategy.COSINE
+            )
+            self.doc_code_indices.append(code)
+        if indices["comment_path"] and os.path.exists(indices["comment_path"]):
+            comment = FAISS.load_local(
+                indices["comment_path"], self.text_model, "index", allow_dangerous_deserialization=True,
+                distance_strategy=DistanceStrategy.COSINE
+            )
+            self.doc_comment_indices.append(comment)
+        self.deleted_docs.discard(doc_path)
+        return text, code, comment
+    
+    def load_documents(self, files: list[tuple[str, str]]) -> list[tuple[str, str]]:
+        """读取合并后的索引并检查全部文档，未修改的文档直接使用缓存并立即发布快照，返回需要重新索引的文档"""
+        stores = None
+        if self.storage.exists():
+            stores = self.storage.load({ "text": self.text_model, "code": self.code_model, "comment": self.text_model })
+            if stores is not None:
+                self.index_stats = dict(self.storage.manifest.get("index_stats", {}))
         
-        if text_index:
-            FAISS.save_local(text_index, text_path)
-        if code_index:
-            FAISS.save_local(code_index, code_path)
-        if comment_index:
-            FAISS.save_local(comment_index, comment_path)
-            
-    def load_document(self, doc_path: str, mode: str, nocache=False):
-        path = Path(doc_path)
-        ext = path.suffix
-        if not os.path.exists(doc_path):
-            tqdm.write(f'Warn: File {doc_path} does not exists.')
-            return
+        to_index: list[tuple[str, str]] = []
+        kept: set[str] = set()
+        for doc_path, mode in tqdm(files, desc="Loading cached documents"):
+            if not os.path.exists(doc_path):
+                tqdm.write(f'Warn: File {doc_path} does not exists.')
+                continue
+            rel_path = os.path.normpath(os.path.relpath(doc_path, self.root_path))
+            cached = self.check_cache(doc_path)
+            if cached and stores is not None and self.storage.documents().get(rel_path, {}).get("hash") == self.documents[doc_path]["hash"]:
+                kept.add(rel_path)
+                self.deleted_docs.discard(doc_path)
+                self.from_cache += 1
+            elif cached and stores is None and self.documents[doc_path].get("text_path") is not None:
+                # 旧版缓存，读取后迁移到合并后的索引
+                self.load_legacy_document(doc_path)
+                self.from_cache += 1
+            else:
+                to_index.append((doc_path, mode))
+            self.progress.advance()
         
-        if self.check_cache(doc_path) and not nocache:
-            # 有缓存，直接从缓存加载
-            indices = self.indices_cache['data'].get(doc_path)
-            text = None
-            code = None
-            comment = None
-            if indices["text_path"] and os.path.exists(indices["text_path"]):
-                text = FAISS.load_local(
-                    indices["text_path"], self.text_model, "index", allow_dangerous_deserialization=True,
-                    distance_strategy=DistanceStrategy.COSINE
-                )
-                self.doc_text_indices.append(text)
-            if indices["code_path"] and os.path.exists(indices["code_path"]):
-                code = FAISS.load_local(
-                    indices["code_path"], self.code_model, "index", allow_dangerous_deserialization=True,
-                    distance_strategy=DistanceStrategy.COSINE
-                )
-                self.doc_code_indices.append(code)
-            if indices["comment_path"] and os.path.exists(indices["comment_path"]):
-                comment = FAISS.load_local(
-                    indices["comment_path"], self.text_model, "index", allow_dangerous_deserialization=True,
-                    distance_strategy=DistanceStrategy.COSINE
-                )
-                self.doc_comment_indices.append(comment)
-            self.deleted_docs.remove(doc_path)
-            return text, code, comment
-            
-        else:
-            # 没有缓存，加载文档并索引
-            if ext == ".md":
-                loader = CodeAwareMDLoader(path)
-                docs = self.splitter.split_documents(loader.load(), mode)
+        tombstones = None
+        if stores is not None:
+            # 已删除或修改的文档按清单中的向量区间整段记入墓碑，启动索引完成后合并时再从数据库中删除
+            stale = [path for path in self.storage.documents() if path not in kept]
+            tombstones = self.storage.tombstones(stale)
+            for path in stale:
+                self.doc_ids.pop(path, None)
+            self.doc_text_indices.append(stores["text"])
+            self.doc_code_indices.append(stores["code"])
+            self.doc_comment_indices.append(stores["comment"])
+        
+        cached = {
+            "text": self.merge_documents_one(self.doc_text_indices),
+            "code": self.merge_documents_one(self.doc_code_indices),
+            "comment": self.merge_documents_one(self.doc_comment_indices)
+        }
+        self.doc_code_indices.clear()
+        self.doc_text_indices.clear()
+        self.doc_comment_indices.clear()
+        # 先发布读取的数据库，已缓存的文档立即可以检索，再按配置检查并优化索引
+        self.publish(cached, tombstones=tombstones)
+        self.progress.begin("optimizing")
+        optimized = dict(cached)
+        self.optimize_stores(optimized, check_recall=True)
+        if any(optimized[name] is not cached[name] for name in STORE_NAMES):
+            self.publish(optimized, tombstones=tombstones)
+        for store in optimized.values():
+            if store is not None:
+                # 之后的重建索引按 id 查找向量位置，提前构建映射
+                docstore_positions(store)
+        return to_index
+    
+    def index_documents(self, items: list[tuple[str, str]]):
+        """分批索引启动时新增或修改的文档，每批完成后放入新增片段并发布快照，已索引的文档立即可以检索
+
+        每批都在新增片段的副本上修改，复制的耗时远小于一批文档的嵌入耗时。
+        """
+        batch_size = max(1, self.config.get("ingest", {}).get("startup_batch_size", 64))
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            snapshot = self.snapshot
+            deltas = { name: clone_store(delta) for name, delta in zip(STORE_NAMES, snapshot.deltas) }
+            try:
+                indexed, new_stores = self.ingest.ingest_merged(batch)
+                self.merge_into_deltas(snapshot, deltas, new_stores)
+                with self.metadata.transaction():
+                    for doc_path, fingerprint in indexed:
+                        self.cache_index(doc_path, fingerprint)
+                        self.deleted_docs.discard(doc_path)
+                self.indexed += len(indexed)
+            except Exception as e:
+                print(f'Index documents failed. exception: {e}')
+                traceback.print_exc()
+                continue
+            finally:
+                self.progress.advance(len(batch))
             
-            else:
-                loader = CodeLoader(path)
-                docs = self.splitter.split_documents(loader.load(), "code-only")
-                
-            text, code, comment = self.parse_one_document(docs, doc_path)
-            if text:
-                self.doc_text_indices.append(text)
-            if code:
-                self.doc_code_indices.append(code)
-            if comment:
-                self.doc_comment_indices.append(comment)
-            self.cache_index(doc_path, text, code, comment)
-            self.indexed += 1
-            if doc_path in self.deleted_docs:
-                self.deleted_docs.remove(doc_path)
-                
-            return text, code, comment
+            self.publish(snapshot.stores(), tuple(deltas[name] for name in STORE_NAMES), snapshot.tombstones)
+            print(f"Indexing documents, {self.progress.describe()}")
+    
+    def merge_into_deltas(self, snapshot: IndexSnapshot, deltas: dict[str, FAISS], new_stores: tuple[FAISS, FAISS, FAISS]):
+        """将新索引的片段放入新增片段的副本 deltas，数据库本身为空时，新索引的数据库直接作为新增片段"""
+        for name, store, new_store in zip(STORE_NAMES, snapshot[:3], new_stores):
+            if new_store is None:
+                continue
+            if deltas[name] is None:
+                deltas[name] = new_store if store is None else empty_delta(store)
+            if deltas[name] is not new_store:
+                merge_stores(deltas[name], new_store)
 
-    def parse_one_document(self, docs: list[Document], path: str):
+    def split_chunks(self, docs: list[Document], path: str):
+        """将分割后的片段分为文本、代码、代码注释三类，并分配片段 id"""
         text_docs = [doc for doc in docs if not doc.metadata.get("is_code", False)]
         code_docs = [doc for doc in docs if doc.metadata.get("is_code", False)]
         
         code_comment_docs: list[Document] = []
+        comment_of: list[tuple[Document, Document]] = []
         for doc in code_docs:
-            comment = doc.metadata.get("comments")
+            comment = doc.metadata.pop("comments", None)
             if comment and comment.strip():
-                metadata = { **doc.metadata, "code": doc.page_content }
-                metadata.pop("comments")
+                metadata = { **doc.metadata }
                 code_comment_docs.append(Document(page_content=comment, metadata=metadata))
+                comment_of.append((code_comment_docs[-1], doc))
         
         path = os.path.normpath(os.path.relpath(path, self.root_path))
-        self.doc_ids[path] = (list(), list(), list())
+        ids = (list(), list(), list())
         i = 0
-        for type, docs in enumerate([text_docs, code_docs, code_comment_docs]):
-            for doc in docs:
+        for type, typed_docs in enumerate([text_docs, code_docs, code_comment_docs]):
+            for doc in typed_docs:
                 doc.id = f"{path}-{i}"
-                self.doc_ids[path][type].append(doc.id)
+                ids[type].append(doc.id)
                 i += 1
+        self.doc_ids[path] = ids
         
-        text_store = FAISS.from_documents(text_docs, self.text_model, distance_strategy=DistanceStrategy.COSINE) if text_docs else None
-        code_store = FAISS.from_documents(code_docs, self.code_model, distance_strategy=DistanceStrategy.COSINE) if code_docs else None
-        comment_store = FAISS.from_documents(code_comment_docs, self.text_model, distance_strategy=DistanceStrategy.COSINE) if code_comment_docs else None
+        # 上下文与注释对应的代码只记录片段 id，检索时再从数据库中读取，数据库中不保存重复的文本
+        for comment_doc, code_doc in comment_of:
+            comment_doc.metadata["code_id"] = code_doc.id
+        for doc in [*text_docs, *code_docs, *code_comment_docs]:
+            for ref_key, id_key in (("prev_refs", "prev_ids"), ("next_refs", "next_ids")):
+                refs = doc.metadata.pop(ref_key, None)
+                if refs:
+                    doc.metadata[id_key] = [docs[pos].id for pos in refs]
         
-        return text_store, code_store, comment_store
-    
+        return text_docs, code_docs, code_comment_docs
+
     def reindex(self, data: list[tuple[str, str]]):
-        for path, mode in tqdm(data, leave=False, desc='Reindexing'):
-            try:
-                self.reindex_document(path, mode)
-            except Exception as e:
-                print(f'Reindex document "{path}" failed. exception: {e}')
-                traceback.print_exc()
-        print(f"✅ Reindexed {len(data)} documents.")
+        """批量重建一批文档的索引
+
+        删除与修改的文档只把旧片段记入墓碑，新增与修改的文档交给索引引擎并行分割、跨文档批量嵌入后放入新增片段的小索引，
+        耗时只与这批文档的大小有关，与数据库的总大小无关。墓碑或新增片段的比例超过 compact_threshold 后，由后台合并整理数据库。
+        修改在新增片段的副本上进行，检索在此期间继续使用旧快照，不会被阻塞。
+        """
+        docs_path = os.path.join(self.root_path, 'docs')
+        to_remove: list[str] = []
+        to_add: list[tuple[str, str]] = []
+        deleted: list[str] = []
+        for doc_path, mode in data:
+            if not is_path_in_directory(doc_path, docs_path):
+                continue
+            path = os.path.normpath(os.path.relpath(doc_path, self.root_path))
+            indexed = path in self.doc_ids
+            if mode == 'delete':
+                if not indexed:
+                    print(f'Warn: Cannot get document identifier for "{doc_path}". This may be a bug for LangBotPluginDocument. Please open an issue with a screenshot for call stack.')
+                    continue
+                deleted.append(doc_path)
+            elif not os.path.exists(doc_path):
+                tqdm.write(f'Warn: File {doc_path} does not exists.')
+                continue
+            else:
+                to_add.append((doc_path, self.config['mode']))
+            # 已经索引过的文档无论删除还是修改都要先删除旧片段
+            if indexed:
+                to_remove.append(doc_path)
         
-        with open(os.path.join(self.root_path, 'config.json'), 'w') as f:
-            json.dump(self.config, f, indent=4)
-        with open(self.indices_path, 'w') as f:
-            json.dump(self.indices_cache, f, indent=4)
+        added = { os.path.normpath(os.path.relpath(doc_path, self.root_path)) for doc_path, _ in to_add }
+        with self.index_lock, self.metadata.transaction():
+            removed, old_ids = self.remove_documents(to_remove)
+            self.unpublished = { **{ path: ([], [], []) for path in added }, **old_ids }
+            for doc_path in deleted:
+                doc_rel_path = os.path.normpath(os.path.relpath(doc_path, docs_path))
+                if doc_rel_path in self.config['files']:
+                    self.config['files'].remove(doc_rel_path)
+                    self.config_dirty = True
         
-        self.doc_code_indices.clear()
-        self.doc_text_indices.clear()
-        self.doc_comment_indices.clear()
+        new_stores = (None, None, None)
+        try:
+            indexed, new_stores = self.ingest.ingest_merged(to_add)
+            with self.metadata.transaction():
+                for doc_path, fingerprint in indexed:
+                    self.cache_index(doc_path, fingerprint)
+                    doc_rel_path = os.path.normpath(os.path.relpath(doc_path, docs_path))
+                    if doc_rel_path not in self.config['files']:
+                        self.config['files'].append(doc_rel_path)
+                        self.config_dirty = True
+        except Exception as e:
+            print(f'Reindex documents failed. exception: {e}')
+            traceback.print_exc()
+        
+        # 只在修改快照时持有锁，耗时与这批文档及新增片段的大小有关，后台合并不会阻塞这里
+        with self.index_lock:
+            snapshot = self.snapshot
+            if self.compaction_journal is not None:
+                # 合并数据库会清空被合并的索引，记入日志的新片段需要单独复制一份
+                self.compaction_journal.append((removed, tuple(clone_store(store) for store in new_stores), old_ids, added))
+            deltas, tombstones = self.apply_changes(snapshot, removed, new_stores)
+            # 索引已经变化，发布新快照后之前缓存的检索结果全部作废
+            self.publish(snapshot.stores(), deltas, tombstones)
+            self.unpublished = {}
+        print(f"✅ Reindexed {len(data)} documents.")
+        
+        if self.config_dirty:
+            self.save_config()
     
-    def reindex_document(self, doc_path: str, mode: str):
-        path = os.path.normpath(os.path.relpath(doc_path, self.root_path))
-        doc_rel_path = os.path.normpath(os.path.relpath(doc_path, os.path.join(self.root_path, 'docs')))
-        ids = self.doc_ids.get(path)
-        if not is_path_in_directory(doc_path, os.path.join(self.root_path, 'docs')):
-            return
-
-        if mode == 'add':
-            # 添加新文档
-            text, code, comment = self.load_document(os.path.join(self.root_path, doc_path), self.config['mode'], True)
-            if text:
-                self.text_store.merge_from(text)
-            if code:
-                self.code_store.merge_from(code)
-            if comment:
-                self.code_comment_store.merge_from(comment)
-            self.config['files'].append(os.path.normpath(os.path.relpath(doc_path, os.path.join(self.root_path, 'docs'))))
-            
-        elif mode == 'delete':
-            # 删除文档
+    def remove_documents(self, doc_paths: list[str]) -> tuple[dict[str, set[str]], dict[str, tuple]]:
+        """删除一批文档的缓存信息，返回每种数据库中需要删除的片段 id，以及每个文档原来的片段 id"""
+        removed: dict[str, set[str]] = { name: set() for name in STORE_NAMES }
+        old_ids: dict[str, tuple] = {}
+        for doc_path in doc_paths:
+            path = os.path.normpath(os.path.relpath(doc_path, self.root_path))
+            ids = self.doc_ids.get(path)
             if ids is None:
-                print(f'Warn: Cannot get document identifier for "{doc_path}". This may be a bug for LangBotPluginDocument. Please open an issue with a screenshot for call stack.')
-                traceback.print_stack()
+                continue
+            old_ids[path] = ids
+            for name, type_ids in zip(STORE_NAMES, ids):
+                removed[name].update(type_ids)
+            self.documents.pop(os.path.join(self.root_path, path), None)
+            self.doc_ids.pop(path, None)
+        return removed, old_ids
+    
+    def apply_changes(
+        self, snapshot: IndexSnapshot, removed: dict[str, set[str]], new_stores: tuple[FAISS, FAISS, FAISS]
+    ) -> tuple[tuple, tuple]:
+        """在快照上删除 removed 中的片段并放入新索引的片段，返回新的 (新增片段, 墓碑)，快照本身不会被修改
+
+        数据库中的片段按 id 找到向量位置记入墓碑，新增片段中的片段直接从副本中删除，耗时与数据库的总大小无关。
+        """
+        deltas: dict[str, FAISS] = {}
+        tombstones: dict[str, frozenset[int]] = {}
+        for name, base, delta, dead in zip(STORE_NAMES, snapshot[:3], snapshot.deltas, snapshot.tombstones):
+            ids = removed.get(name)
+            delta = clone_store(delta)
+            if ids and base is not None:
+                positions = docstore_positions(base)
+                dead = dead.union(positions[id] for id in ids if id in positions)
+            if ids and delta is not None:
+                remove_positions(
+                    delta, { pos for pos, id in delta.index_to_docstore_id.items() if id in ids },
+                    lambda keep: self.original_vectors(delta, keep)
+                )
+            deltas[name] = delta
+            tombstones[name] = dead
+        self.merge_into_deltas(snapshot, deltas, new_stores)
+        return tuple(deltas[name] for name in STORE_NAMES), tuple(tombstones[name] for name in STORE_NAMES)
+    
+    def needs_compaction(self) -> bool:
+        """墓碑或新增片段的比例是否超过 compact_threshold"""
+        fraction = self.snapshot.pending_fraction()
+        return fraction > 0 and fraction >= self.config.get("index", {}).get("compact_threshold", 0.1)
+    
+    def compact(self):
+        """合并墓碑与新增片段，生成新的数据库并写入索引缓存，由重建索引调度器在后台调用
+
+        合并从当时的快照开始，耗时与数据库大小成正比，期间不持有锁，检索与重建索引照常进行，
+        重建索引的修改会记入 compaction_journal，合并完成后只在持有锁时把这些修改重新应用到新的数据库上再发布。
+        """
+        start = time.perf_counter()
+        with self.index_lock:
+            snapshot = self.snapshot
+            if self.compacting or snapshot.pending_fraction() == 0:
                 return
-                
-            text_ids, code_ids, comment_ids = ids
-            if len(text_ids) > 0:
-                self.text_store.delete(text_ids)
-            if len(code_ids) > 0:
-                self.code_store.delete(code_ids)
-            if len(comment_ids) > 0:
-                self.code_comment_store.delete(comment_ids)
-            # 缓存也得删
-            abs_path = os.path.join(self.root_path, path)
-            if self.indices_cache['data'].get(abs_path):
-                self.indices_cache['data'].pop(abs_path)
-            if self.doc_ids.get(path):
-                self.doc_ids.pop(path)
-            if doc_rel_path in self.config['files']:
-                self.config['files'].remove(doc_rel_path)
+            self.compacting = True
+            self.compaction_journal = []
+        
+        try:
+            changed = self.merge_pending(snapshot)
+            with self.index_lock:
+                merged = IndexSnapshot(*(changed.get(name, store) for name, store in snapshot.stores().items()))
+                touched: dict[str, list[tuple]] = {}
+                for removed, new_stores, old_ids, added in self.compaction_journal:
+                    deltas, tombstones = self.apply_changes(merged, removed, new_stores)
+                    merged = merged._replace(deltas=deltas, tombstones=tombstones)
+                    for path, ids in old_ids.items():
+                        touched.setdefault(path, []).append(ids)
+                    for path in added:
+                        touched.setdefault(path, [])
+                # 正在重建索引的文档元数据已经修改，但片段还没有发布，同样按修改过的文档处理
+                for path, ids in self.unpublished.items():
+                    touched.setdefault(path, []).append(ids)
+                self.publish(merged.stores(), merged.deltas, merged.tombstones)
+                self.compaction_journal = None
+                doc_ids = dict(self.doc_ids.items())
+                hashes = self.document_hashes()
             
-        elif mode == 'modify':
-            # 修改文档，先删除再添加
-            if ids is not None:
-                self.reindex_document(doc_path, 'delete')
-            self.reindex_document(doc_path, 'add')
+            # 合并期间修改过的文档不在写入的数据库中（或只有旧片段），清单中不记录哈希，下次启动时重新索引；
+            # 同时记录新旧片段 id，下次启动时可以按向量区间删除旧片段
+            for path, old in touched.items():
+                hashes[path] = None
+                ids = doc_ids.get(path, ([], [], []))
+                for other in old:
+                    ids = tuple(list(dict.fromkeys([*current, *previous])) for current, previous in zip(ids, other))
+                doc_ids[path] = ids
+            self.storage.save(merged.stores(), doc_ids, hashes, self.index_stats)
+            self.collect_embedding_cache()
+        finally:
+            with self.index_lock:
+                self.compacting = False
+                self.compaction_journal = None
+        
+        elapsed = time.perf_counter() - start
+        self.compactions += 1
+        self.last_compaction = elapsed
+        self.total_compaction += elapsed
+        print(f"✅ Compacted {', '.join(changed)} stores in {elapsed:.1f}s.")
+    
+    def merge_pending(self, snapshot: IndexSnapshot) -> dict[str, FAISS]:
+        """将快照中的墓碑与新增片段合并为新的数据库并按配置优化，返回有变化的数据库，快照本身不会被修改"""
+        changed: dict[str, FAISS] = {}
+        for name, base, delta, dead in zip(STORE_NAMES, snapshot[:3], snapshot.deltas, snapshot.tombstones):
+            if base is None:
+                if delta is not None:
+                    changed[name] = clone_store(delta)
+                continue
+            if not dead and (delta is None or delta.index.ntotal == 0):
+                continue
+            # 压缩或降维的索引用原始向量重新构建，避免近似向量的误差逐次累积
+            store = clone_store(base)
+            remove_positions(store, set(dead), lambda keep: self.original_vectors(base, keep))
+            if delta is not None and delta.index.ntotal > 0:
+                merge_stores(store, delta, lambda positions: self.original_vectors(delta, positions))
+            changed[name] = store
+        
+        self.optimize_stores(changed)
+        for store in changed.values():
+            # 之后的重建索引按 id 查找向量位置，提前在后台构建映射
+            docstore_positions(store)
+        return changed
     
     def merge_documents_one(self, indices: list[FAISS]):
+        indices = [index for index in indices if index]
         if not indices:
             return None
         store = indices[0]
-        if not store:
-            return None
+        # 旧版缓存的数据库使用 InMemoryDocstore，合并前转换为紧凑格式
+        store.docstore = CompactDocstore.from_docstore(store.docstore, list(store.index_to_docstore_id.values()))
         for one in indices[1:]:
-            store.merge_from(one)
+            merge_stores(store, one)
         return store
+    
+    def original_vectors(self, store: FAISS, positions: list[int] = None) -> np.ndarray:
+        """取出片段的原始向量，优先使用嵌入缓存，缓存中没有的片段会重新嵌入"""
+        if positions is None:
+            positions = range(store.index.ntotal)
+        texts = [store.docstore.text(store.index_to_docstore_id[pos]) for pos in positions]
+        vectors = self.ingest.embed(store.embedding_function, texts, "Restoring vectors")
+        return np.array(vectors, dtype=np.float32).reshape(len(texts), store.index.d)
+    
+    def optimize_stores(self, stores: dict[str, FAISS], check_recall=False):
+        """按 index 配置转换每种数据库的索引类型、压缩与降维方式
+
+        PCA 降维会抽样检查新片段是否使丢失的方差明显增加，超过 projection_drift 时重新训练。
+        重建索引时会用原始向量检查召回率，check_recall 时（启动时）还会检查可以还原原始向量的索引，并输出占用空间。
+        需要重建的数据库会在 stores 中替换为新的数据库对象，不修改可能已经发布的数据库。
+        """
+        index_config = self.config.get("index", {})
+        for name, store in stores.items():
+            if store is None:
+                continue
+            spec = index_spec(index_config, name)
+            stats = self.index_stats.setdefault(name, {})
+            rebuild = needs_rebuild(store.index, spec)
             
-    def merge_documents(self):
-        """将所有数据库合并"""
-        self.text_store = self.merge_documents_one(self.doc_text_indices)
-        self.code_store = self.merge_documents_one(self.doc_code_indices)
-        self.code_comment_store = self.merge_documents_one(self.doc_comment_indices)
+            if not rebuild and index_projection(store.index)[0] == "pca" and "projection_error" in stats:
+                rng = np.random.default_rng()
+                sample = rng.choice(store.index.ntotal, min(DRIFT_SAMPLES, store.index.ntotal), replace=False)
+                error = projection_error(store.index, self.original_vectors(store, sample.tolist()))
+                if error - stats["projection_error"] > spec.get("projection_drift", 0.05):
+                    print(f"PCA projection of {name} store drifted ({stats['projection_error']:.3f} -> {error:.3f} variance lost), retraining.")
+                    rebuild = True
+            
+            vectors = None
+            if rebuild:
+                # 压缩或降维后索引中只剩近似向量，需要用原始向量重新训练
+                vectors = index_vectors(store.index) if is_lossless(store.index) else self.original_vectors(store)
+                store = stores[name] = FAISS(
+                    store.embedding_function, build_index(vectors, store.index.metric_type, spec),
+                    store.docstore, store.index_to_docstore_id, distance_strategy=store.distance_strategy
+                )
+                projection, dim = index_projection(store.index)
+                print(
+                    f"✅ Built {index_type(store.index)} index ({index_compression(store.index)}"
+                    + (f", {projection} {dim}d" if projection != "none" else "")
+                    + f") for {name} store with {store.index.ntotal} vectors."
+                )
+                stats["projection_error"] = projection_error(store.index, vectors)
+            else:
+                tune_index(store.index, spec)
+            
+            if is_exact(store.index):
+                self.index_stats.pop(name)
+                continue
+            k = spec.get("recall_k", 10)
+            samples = spec.get("recall_samples", 100)
+            if samples > 0 and (vectors is not None or (check_recall and is_lossless(store.index))):
+                stats["recall"] = recall_at_k(store.index, k, samples, vectors)
+            if vectors is not None or check_recall:
+                stats["bytes"] = index_bytes(store.index)
+                raw = store.index.ntotal * store.index.d * 4
+                print(
+                    f"✅ {name} store: {stats['bytes'] / 2**20:.1f} MB index, {raw / 2**20:.1f} MB as float32"
+                    + (f", recall@{k}: {stats['recall']:.3f}" if "recall" in stats else "")
+                    + (f", variance lost by projection: {stats['projection_error']:.3f}" if stats.get("projection_error") else "")
+                )
+    
+    def publish(self, stores: dict[str, FAISS], deltas: tuple = (None, None, None), tombstones: tuple = None):
+        """发布新的数据库快照，之后的检索都会使用新快照"""
+        self.snapshot = IndexSnapshot(
+            stores["text"], stores["code"], stores["comment"], self.snapshot.generation + 1,
+            deltas, tombstones or (frozenset(), frozenset(), frozenset())
+        )
+        if self.retriever:
+            self.retriever.publish(self.snapshot)
+    
+    def save_stores(self):
+        """将当前快照中的数据库写入索引缓存，只在没有墓碑与新增片段时（启动或合并后）调用
 
+        之后修改的文档在清单中的哈希与元数据不一致，下次启动时会重新索引。
+        """
+        self.storage.save(self.snapshot.stores(), dict(self.doc_ids.items()), self.document_hashes(), self.index_stats)
+    
+    def document_hashes(self) -> dict[str, str]:
+        """每个文档的内容哈希，键为文档相对于插件目录的路径"""
+        return {
+            os.path.normpath(os.path.relpath(path, self.root_path)): indices["hash"]
+            for path, indices in self.documents.items()
+        }
+    
+    def save_config(self):
+        """写回配置文件，先写临时文件再替换，避免写入中途崩溃损坏配置"""
+        config_path = os.path.join(self.root_path, 'config.json')
+        with open(f"{config_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(self.config, f, ensure_ascii=False, indent=4)
+        os.replace(f"{config_path}.tmp", config_path)
+        self.config_dirty = False
+            
+    def create_retriever(self):
+        """模型加载后创建检索器，之后发布的快照都会交给检索器"""
+        cache_config = self.config.get("cache", {})
+        search_config = self.config.get("search", {})
         self.retriever = HybridRetriever(
-            text_store=self.text_store,
-            code_store=self.code_store,
-            code_comment_store=self.code_comment_store,
-            classification=Classification(self.root_path, self.config["extensions"]["classification"])
+            snapshot=self.snapshot,
+            classification=Classification(self.root_path, self.config["extensions"]["classification"]),
+            vector_cache_size=cache_config.get("query_vector_size", 512),
+            semantic_cache_size=cache_config.get("semantic_size", 256),
+            semantic_threshold=cache_config.get("semantic_threshold", 0.95),
+            store_workers=search_config.get("store_workers", 6),
+            store_timeout=search_config.get("store_timeout", 5)
         )
-        
-        for deleted in self.deleted_docs:
-            if self.indices_cache['data'].get(deleted):
-                self.indices_cache['data'].pop(deleted)
+    
+    def merge_documents(self):
+        """启动时的文档全部索引后，将新增片段合并进数据库，并写入索引缓存"""
+        with self.index_lock:
+            snapshot = self.snapshot
+            changed = self.merge_pending(snapshot)
+            if changed:
+                self.publish({ **snapshot.stores(), **changed })
+            
+            for deleted in self.deleted_docs:
+                self.documents.pop(deleted, None)
+                self.doc_ids.pop(os.path.normpath(os.path.relpath(deleted, self.root_path)), None)
+            
+            self.save_stores()
+            self.clear_legacy_cache()
+            # 清理需要读取并哈希全部片段，只在片段有变化时进行，没有变化的启动不读取片段文本
+            if changed:
+                self.collect_embedding_cache()
+            else:
+                self.embedding_cache.gc()
         
         if self.new_doc > 0:
             print(f"✅ Find {self.new_doc} new documents.")
@@ -379,13 +792,93 @@ class DocumentParser:
             print(f"✅ Loaded {self.from_cache} stores from cache.")
         if self.indexed > 0:
             print(f"✅ Index and cached {self.indexed} stores.")
-            
-        self.doc_code_indices.clear()
-        self.doc_text_indices.clear()
-        self.doc_comment_indices.clear()
-            
-        return self.indices_cache
 
+    def collect_embedding_cache(self):
+        """清理嵌入缓存中已经没有任何片段引用的向量，耗时与片段总数成正比，只在启动时片段有变化或后台合并后调用"""
+        referenced: dict[str, set[str]] = {}
+        for store in (*self.snapshot[:3], *self.snapshot.deltas):
+            if store is None:
+                continue
+            model_name = getattr(store.embedding_function, "model_name", type(store.embedding_function).__name__)
+            hashes = referenced.setdefault(model_name, set())
+            for doc_id in store.index_to_docstore_id.values():
+                hashes.add(content_hash(store.docstore.text(doc_id)))
+        self.embedding_cache.gc(referenced)
+    
     def search(self, message: str) -> list[Document]:
-        return self.retriever.search(message)
+        key = normalize_query(message)
+        snapshot = self.snapshot
+        docs = self.result_cache.lookup(key, snapshot.generation)
+        if docs is None:
+            timeouts = self.retriever.timeouts()
+            docs = self.retriever.search(message, snapshot)
+            if self.retriever.timeouts() == timeouts:
+                self.result_cache.store(key, docs, snapshot.generation)
+        return list(docs)
+    
+    async def asearch(self, message: str) -> list[Document]:
+        """在线程池中检索，不阻塞事件循环，超时会抛出 asyncio.TimeoutError"""
+        return await self.executor.run(message)
+    
+    def stats(self) -> dict:
+        """获取检索相关的统计信息"""
+        snapshot = self.snapshot
+        stats = {
+            "search": self.executor.stats(),
+            "result_cache": self.result_cache.stats(),
+            "embedding_cache": self.embedding_cache.stats(),
+            "reindex": self.watcher.scheduler.stats(),
+            "context": self.packer.stats(),
+            "startup": self.progress.stats(),
+            "index": {
+                name: {
+                    "type": index_type(store.index),
+                    "compression": index_compression(store.index),
+                    "projection": index_projection(store.index),
+                    "vectors": store.index.ntotal,
+                    "raw_bytes": store.index.ntotal * store.index.d * 4,
+                    "docstore": store.docstore.stats(),
+                    "tombstones": len(dead),
+                    "delta": delta.index.ntotal if delta is not None else 0,
+                    **self.index_stats.get(name, {})
+                }
+                for name, store, delta, dead in zip(STORE_NAMES, snapshot[:3], snapshot.deltas, snapshot.tombstones)
+                if store is not None
+            },
+            "compaction": {
+                "compactions": self.compactions,
+                "last_seconds": self.last_compaction,
+                "total_seconds": self.total_compaction,
+                "pending_fraction": snapshot.pending_fraction(),
+                "running": self.compacting
+            }
+        }
+        if self.retriever:
+            stats["query_vector_cache"] = self.retriever.vector_cache.stats()
+            stats["fan_out"] = self.retriever.stats()
+            stats["semantic_cache"] = self.retriever.semantic_cache.stats()
+            stats["classification"] = self.retriever.classification.stats()
+        if self.text_model:
+            stats["text_embedding"] = self.text_model.stats()
+        if self.code_model:
+            stats["code_embedding"] = self.code_model.stats()
+        return stats
+    
+    async def report_stats(self, interval: float):
+        """每隔 interval 秒在日志中输出一次统计信息"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                print(f"RAG stats: {json.dumps(self.stats(), ensure_ascii=False, default=str)}")
+            except Exception as e:
+                print(f"Warn: Collecting stats failed. exception: {e}")
+    
+    def close(self):
+        if self.stats_task:
+            self.stats_task.cancel()
+        self.watcher.end()
+        self.executor.shutdown()
+        if self.retriever:
+            self.retriever.shutdown()
+        self.metadata.close()
     
\ No newline at end of file
@@ -0,0 +1,91 @@
+import time
+import threading
+
+class IndexProgress:
+    """启动索引的进度与就绪状态，在后台线程中更新，可以在任意线程中读取
+
+    阶段依次为 models（加载模型）、loading（读取索引缓存并检查文档）、optimizing（按配置检查并优化读取的索引）、
+    indexing（索引新增或修改的文档）、merging（合并并写入索引缓存）、ready，出错时为 failed。
+    读取缓存后就会发布快照，从 optimizing 阶段开始即可检索。
+    """
+    STAGES = ("models", "loading", "optimizing", "indexing", "merging", "ready")
+    SEARCHABLE = ("optimizing", "indexing", "merging", "ready")
+    """已经发布过快照、可以检索的阶段"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stage = "models"
+        self.done = 0
+        self.total = 0
+        self.started = time.monotonic()
+        self.stage_started = self.started
+        self.finished: float = None
+        self.error: str = None
+
+    def begin(self, stage: str, total=0):
+        with self.lock:
+            self.stage = stage
+            self.done = 0
+            self.total = total
+            self.stage_started = time.monotonic()
+
+    def advance(self, count=1):
+        with self.lock:
+            self.done += count
+
+    def finish(self):
+        with self.lock:
+            self.stage = "ready"
+            self.finished = time.monotonic()
+        self.ready.set()
+
+    def fail(self, error: Exception):
+        with self.lock:
+            self.stage = "failed"
+            self.error = str(error)
+            self.finished = time.monotonic()
+        self.ready.set()
+
+    def searchable(self) -> bool:
+        return self.stage in self.SEARCHABLE
+
+    def eta(self) -> float:
+        """按当前阶段已完成部分的速度估算剩余时间（秒），无法估算时返回 None"""
+        with self.lock:
+            if self.done <= 0 or self.total <= 0:
+                return None
+            elapsed = time.monotonic() - self.stage_started
+            return elapsed / self.done * max(0, self.total - self.done)
+
+    def describe(self) -> str:
+        """一行进度描述，用于输出日志"""
+        eta = self.eta()
+        return (
+            f"{self.stage}: {self.done}/{self.total}"
+            + (f", ETA {eta:.0f}s" if eta is not None else "")
+        )
+
+    def stats(self) -> dict:
+        eta = self.eta()
+        with self.lock:
+            end = self.finished if self.finished is not None else time.monotonic()
+            return {
+                "stage": self.stage,
+                "done": self.done,
+                "total": self.total,
+                "percent": 100.0 if self.stage == "ready" else (self.done / self.total * 100 if self.total else 0.0),
+                "eta_seconds": eta if eta is not None else 0.0,
+                "elapsed_seconds": end - self.started,
+                "error": self.error
+            }
+
+    def render(self, template: str) -> str:
+        """替换提示中的进度占位符，数值取整，其他花括号原样保留"""
+        values = {
+            key: value if isinstance(value, str) else f"{value:.0f}"
+            for key, value in self.stats().items() if key != "error"
+        }
+        for key, value in values.items():
+            template = template.replace("{" + key + "}", value)
+        return template
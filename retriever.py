@@ -1,38 +1,132 @@
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError, wait
 from langchain_core.vectorstores import VectorStoreRetriever
-from langchain_community.vectorstores import FAISS
 from .extensions.classification import Classification
+from .cache import LRUCache, SemanticCache, normalize_query
+from .store import IndexSnapshot
 
 class HybridRetriever:
-    text_store: FAISS
-    code_store: FAISS
-    code_comment_store: FAISS
+    snapshot: IndexSnapshot
+    """当前的数据库快照，每次检索只读取一次，重建索引时整体替换"""
     classification: Classification
+    vector_cache: LRUCache
+    """提问向量缓存，键为 (模型名称, 规范化后的提问)"""
+    semantic_cache: SemanticCache
+    """语义缓存，相近的提问会跳过检索与分类"""
+    pool: ThreadPoolExecutor
+    """并行嵌入提问、检索三个数据库的线程池，与检索线程池分开，避免检索线程互相等待造成死锁"""
+    store_timeout: float = 5
+    """单个数据库嵌入或检索的超时时间（秒），超时的数据库本次不返回结果，不影响其他数据库"""
     
     def __init__(
         self,
-        text_store: FAISS, code_store: FAISS, code_comment_store: FAISS,
-        classification: Classification
+        snapshot: IndexSnapshot,
+        classification: Classification, vector_cache_size=512,
+        semantic_cache_size=256, semantic_threshold=0.95,
+        store_workers=6, store_timeout=5
     ):
-        self.text_store = text_store
-        self.code_store = code_store
-        self.code_comment_store = code_comment_store
+        self.snapshot = snapshot
         self.classification = classification
+        self.vector_cache = LRUCache(vector_cache_size)
+        self.semantic_cache = SemanticCache(semantic_cache_size, semantic_threshold)
+        self.semantic_cache.invalidate(snapshot.generation)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, store_workers), thread_name_prefix="rag-store")
+        self.store_timeout = store_timeout
+        self.embed_timeouts = 0
+        self.store_timeouts = 0
+        self.classified = 0
+        self.skipped = 0
+        self.stores_skipped = 0
     
-    def _get_relevant_documents_classified(self, query: str):
-        text_docs = self.text_store.similarity_search_with_score(query, k=6)
-        code_docs = self.code_store.similarity_search_with_score(query, k=6)
-        comment_docs = self.code_comment_store.similarity_search_with_score(query, k=6)
+    def publish(self, snapshot: IndexSnapshot):
+        """替换数据库快照，正在进行的检索会继续使用旧快照"""
+        self.snapshot = snapshot
+        self.semantic_cache.invalidate(snapshot.generation)
+    
+    def _embed(self, model, normalized: str) -> list[float]:
+        key = (getattr(model, "model_name", id(model)), normalized)
+        vector = self.vector_cache.get(key)
+        if vector is None:
+            vector = model.embed_query(normalized)
+            self.vector_cache.put(key, vector)
+        return vector
+    
+    def embed_query(self, query: str, snapshot: IndexSnapshot) -> dict[int, list[float]]:
+        """每个嵌入模型只计算一次提问向量，文本库与注释库共用同一个向量，不同模型并行计算"""
+        normalized = normalize_query(query)
+        futures: dict[int, Future] = {}
+        for i in range(3):
+            model = snapshot.embedding(i)
+            if model is None or id(model) in futures:
+                continue
+            futures[id(model)] = self.pool.submit(self._embed, model, normalized)
+        
+        wait(futures.values(), timeout=self.store_timeout)
+        vectors: dict[int, list[float]] = {}
+        for model_id, future in futures.items():
+            if future.done():
+                vectors[model_id] = future.result()
+            else:
+                future.cancel()
+                self.embed_timeouts += 1
+                print("Warn: Embedding query timed out, stores using this model are skipped.")
+        return vectors
+    
+    def _search_stores(self, snapshot: IndexSnapshot, vectors: dict[int, list[float]], ks: tuple[int, int, int]):
+        """并行检索三个数据库，返回 (文本, 代码, 注释) 的检索结果，不存在、没有提问向量或超时的数据库返回空列表"""
+        futures: list[Future] = []
+        for i, k in enumerate(ks):
+            model = snapshot.embedding(i)
+            vector = vectors.get(id(model)) if model is not None else None
+            if vector is None or k <= 0:
+                futures.append(None)
+                continue
+            futures.append(self.pool.submit(snapshot.search, i, vector, k))
+        
+        wait([future for future in futures if future], timeout=self.store_timeout)
+        results = []
+        for future in futures:
+            if future is None:
+                results.append([])
+            elif future.done():
+                results.append(future.result())
+            else:
+                future.cancel()
+                self.store_timeouts += 1
+                print("Warn: Store search timed out, its results are skipped.")
+                results.append([])
+        return results
+    
+    def _get_relevant_documents_classified(
+        self, query: str, vectors: dict[int, list[float]], snapshot: IndexSnapshot, classified: Future
+    ):
+        # 语义缓存未命中时才分类，分类结果出来之前不检索
+        try:
+            need_doc, code_weight = classified.result(timeout=self.store_timeout)
+        except TimeoutError:
+            # 分类超时时按需要文档处理，三个数据库同等权重
+            print("Warn: Query classification timed out, searching all stores.")
+            need_doc, code_weight = True, 0.5
+        
+        self.classified += 1
+        if not need_doc:
+            self.skipped += 1
+            return []
         
-        return [doc[0] for doc in self.classification.classify_and_sort(query, code_docs, comment_docs, text_docs)]
+        ks = self.classification.store_k(code_weight)
+        self.stores_skipped += sum(1 for i, k in enumerate(ks) if snapshot.embedding(i) is not None and k == 0)
+        text_docs, code_docs, comment_docs = self._search_stores(snapshot, vectors, ks)
+        
+        return [doc[0] for doc in self.classification.sort(code_docs, comment_docs, text_docs, code_weight)]
     
-    def _get_relevant_documents_defaults(self, query: str):
+    def _get_relevant_documents_defaults(self, query: str, vectors: dict[int, list[float]], snapshot: IndexSnapshot):
         res = []
 
         # 初始化 deque
-        text_docs = deque(self.text_store.similarity_search(query, k=6)) if self.text_store else deque()
-        code_docs = deque(self.code_store.similarity_search(query)) if self.code_store else deque()
-        code_comment_docs = deque(self.code_comment_store.similarity_search(query)) if self.code_comment_store else deque()
+        text_results, code_results, comment_results = self._search_stores(snapshot, vectors, (6, 4, 4))
+        text_docs = deque(doc for doc, _ in text_results)
+        code_docs = deque(doc for doc, _ in code_results)
+        code_comment_docs = deque(doc for doc, _ in comment_results)
 
         # 如果所有检索器为空，直接返回空列表
         if not any([text_docs, code_docs, code_comment_docs]):
@@ -59,8 +153,52 @@ class HybridRetriever:
 
         return res
     
-    def search(self, query: str):
+    def search(self, query: str, snapshot: IndexSnapshot = None):
+        # 整个检索过程只使用同一个快照，重建索引不会影响正在进行的检索
+        if snapshot is None:
+            snapshot = self.snapshot
+        timeouts = self.timeouts()
+        vectors = self.embed_query(query, snapshot)
+        if not vectors:
+            return []
+        
+        # 以第一个模型（优先文本模型）的向量查询语义缓存，该模型超时时不使用语义缓存，命中时跳过检索与分类
+        key_model = next(id(snapshot.embedding(i)) for i in range(3) if snapshot.embedding(i) is not None)
+        key_vector = vectors.get(key_model)
+        if key_vector is not None:
+            cached = self.semantic_cache.lookup(key_vector)
+            if cached is not None:
+                return list(cached)
+        
+        classified = None
         if self.classification.enabled():
-            return self._get_relevant_documents_classified(query)
+            classified = self.pool.submit(self.classification.classify, query)
+        if classified is not None:
+            docs = self._get_relevant_documents_classified(query, vectors, snapshot, classified)
         else:
-            return self._get_relevant_documents_defaults(query)
+            docs = self._get_relevant_documents_defaults(query, vectors, snapshot)
+        
+        # 上下文与代码只以片段 id 保存，返回前从同一个快照中读取
+        docs = [snapshot.resolve_context(doc) for doc in docs]
+        
+        # 有数据库超时的结果不完整，不写入缓存
+        if key_vector is not None and self.timeouts() == timeouts:
+            self.semantic_cache.store(key_vector, docs, snapshot.generation)
+        return docs
+    
+    def timeouts(self) -> int:
+        """超时次数，并发检索时也会计入其他检索的超时，用于保守地判断结果是否完整"""
+        return self.embed_timeouts + self.store_timeouts
+    
+    def stats(self) -> dict:
+        return {
+            "embed_timeouts": self.embed_timeouts,
+            "store_timeouts": self.store_timeouts,
+            "classified": self.classified,
+            "skipped": self.skipped,
+            "skip_rate": self.skipped / self.classified if self.classified else 0.0,
+            "stores_skipped": self.stores_skipped
+        }
+    
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
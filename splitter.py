@@ -324,18 +324,30 @@ class DocumentSplitter(TextSplitter):
                 # 使用字典暂存结果
                 chunk_map[i] = splitter(doc)
 
+            # 每个文档的片段在结果中的起始位置
+            offsets: dict[int, int] = {}
+            offset = 0
+            for i, splitted in chunk_map.items():
+                offsets[i] = offset
+                offset += len(splitted)
+            
+            def positions(i: int) -> list[int]:
+                start = offsets.get(i, 0)
+                return list(range(start, start + len(chunk_map.get(i, []))))
+
             # 遍历字典，然后对片段注入上下文
+            # 上下文只记录相邻片段在结果中的位置（prev_refs、next_refs），分配片段 id 后再换成 id，不复制文本
             for i, splitted in chunk_map.items():
                 if not splitted:
                     continue
                 
-                prev_context = "\n".join([doc.page_content for doc in chunk_map.get(i - 1, [])[-self.code_context_length:]])
-                next_context = "\n".join([doc.page_content for doc in chunk_map.get(i + 1, [])[:self.code_context_length]])
+                prev_refs = positions(i - 1)[-self.code_context_length:]
+                next_refs = positions(i + 1)[:self.code_context_length]
 
-                if prev_context:
-                    splitted[0].metadata["prev_context"] = prev_context
-                if next_context:
-                    splitted[-1].metadata["next_context"] = next_context
+                if prev_refs:
+                    splitted[0].metadata["prev_refs"] = prev_refs
+                if next_refs:
+                    splitted[-1].metadata["next_refs"] = next_refs
 
                 chunks.extend(splitted)
 
@@ -0,0 +1,605 @@
+import os
+import json
+import math
+import pickle
+import weakref
+import faiss
+import numpy as np
+from typing import Callable, NamedTuple
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import FAISS, DistanceStrategy
+from .docstore import CompactDocstore
+
+STORE_NAMES = ("text", "code", "comment")
+"""三种数据库的名称，顺序与 doc_ids 中的三个列表一致"""
+
+class IndexSnapshot(NamedTuple):
+    """数据库的不可变快照，检索只读取快照，重建索引时在副本上修改，完成后整体替换
+
+    重建索引不修改三个数据库本身：删除的片段记录在墓碑中，新增的片段放在每种数据库各自的小索引（delta）中，
+    检索时跳过墓碑并合并两边的结果，后台合并（compact）后才生成新的数据库。
+    """
+    text_store: FAISS
+    code_store: FAISS
+    code_comment_store: FAISS
+    generation: int = 0
+    """快照版本号，每次发布新快照递增"""
+    deltas: tuple[FAISS, FAISS, FAISS] = (None, None, None)
+    """上次合并之后新增的片段"""
+    tombstones: tuple[frozenset[int], frozenset[int], frozenset[int]] = (frozenset(), frozenset(), frozenset())
+    """三个数据库中已删除片段的向量位置"""
+
+    def stores(self) -> dict[str, FAISS]:
+        return dict(zip(STORE_NAMES, self[:3]))
+
+    def embedding(self, i: int) -> Embeddings:
+        """第 i 种数据库的嵌入模型，数据库与新增片段都不存在时返回 None"""
+        store = self[i] if self[i] is not None else self.deltas[i]
+        return store.embedding_function if store is not None else None
+
+    def search(self, i: int, vector: list[float], k: int) -> list[tuple[Document, float]]:
+        """检索第 i 种数据库与其新增片段，跳过墓碑中的片段，按距离合并两边的结果"""
+        store = self[i] if self[i] is not None else self.deltas[i]
+        if store is None:
+            return []
+        results = search_store(self[i], vector, k, self.tombstones[i]) + search_store(self.deltas[i], vector, k)
+        results.sort(key=lambda item: item[1], reverse=store.index.metric_type == faiss.METRIC_INNER_PRODUCT)
+        return results[:k]
+
+    def chunks(self) -> int:
+        """可以检索到的片段数，不包括墓碑中的片段"""
+        count = 0
+        for store, delta, dead in zip(self[:3], self.deltas, self.tombstones):
+            count += (store.index.ntotal - len(dead) if store is not None else 0)
+            count += delta.index.ntotal if delta is not None else 0
+        return count
+
+    def pending_fraction(self) -> float:
+        """墓碑或新增片段占对应数据库的最大比例，数据库为空但有新增片段时为 1"""
+        fraction = 0.0
+        for store, delta, dead in zip(self[:3], self.deltas, self.tombstones):
+            added = delta.index.ntotal if delta is not None else 0
+            if store is None or store.index.ntotal == 0:
+                if added or dead:
+                    fraction = 1.0
+                continue
+            fraction = max(fraction, len(dead) / store.index.ntotal, added / store.index.ntotal)
+        return fraction
+
+    def document(self, doc_id: str) -> Document:
+        """按片段 id 在文本库与代码库中查找片段，新增片段优先（修改后的文档与旧片段 id 相同），找不到时返回 None"""
+        for store in (*self.deltas[:2], *self[:2]):
+            if store is not None:
+                doc = store.docstore.search(doc_id)
+                if isinstance(doc, Document):
+                    return doc
+        return None
+
+    def resolve_context(self, doc: Document) -> Document:
+        """按片段记录的相邻片段 id 与代码片段 id 读取上下文与代码，返回补全了 prev_context、next_context 与 code 的副本
+
+        旧版缓存的片段直接保存了这些文本，原样返回。
+        """
+        if not any(key in doc.metadata for key in ("prev_ids", "next_ids", "code_id")):
+            return doc
+        metadata = dict(doc.metadata)
+        for key, name in (("prev_ids", "prev_context"), ("next_ids", "next_context")):
+            neighbours = [self.document(doc_id) for doc_id in metadata.pop(key, [])]
+            context = "\n".join(neighbour.page_content for neighbour in neighbours if neighbour is not None)
+            if context:
+                metadata[name] = context
+        code_id = metadata.pop("code_id", None)
+        code = self.document(code_id) if code_id is not None else None
+        if code is not None:
+            metadata["code"] = code.page_content
+        return Document(id=doc.id, page_content=doc.page_content, metadata=metadata)
+
+_positions: "weakref.WeakKeyDictionary[FAISS, tuple[dict, dict[str, int]]]" = weakref.WeakKeyDictionary()
+"""每个数据库的片段 id 到向量位置的映射缓存，数据库释放后自动删除"""
+
+def docstore_positions(store: FAISS) -> dict[str, int]:
+    """片段 id 到向量位置的映射，只用于发布后不再修改的数据库，同一个数据库只构建一次"""
+    cached = _positions.get(store)
+    if cached is None or cached[0] is not store.index_to_docstore_id:
+        cached = (store.index_to_docstore_id, { id: pos for pos, id in store.index_to_docstore_id.items() })
+        _positions[store] = cached
+    return cached[1]
+
+def clone_store(store: FAISS) -> FAISS:
+    """复制一个数据库用于修改，向量索引会整体复制，片段对象本身在新旧数据库间共享"""
+    if store is None:
+        return None
+    return FAISS(
+        store.embedding_function, faiss.clone_index(store.index),
+        CompactDocstore.from_docstore(store.docstore, list(store.index_to_docstore_id.values())),
+        dict(store.index_to_docstore_id),
+        distance_strategy=store.distance_strategy
+    )
+
+INDEX_TYPES = ("flat", "hnsw", "ivf")
+"""支持的索引类型：精确检索、HNSW 图索引、IVF 倒排索引"""
+COMPRESSIONS = ("none", "fp16", "sq8", "pq")
+"""支持的向量压缩方式：不压缩、半精度、8 位标量量化、乘积量化"""
+PQ_MIN_TRAIN = 256 * 39
+"""乘积量化训练每个子量化器的 256 个中心所需的最少向量数"""
+PROJECTIONS = ("none", "pca", "random")
+"""支持的降维方式：不降维、PCA、随机正交投影"""
+DRIFT_SAMPLES = 256
+"""检查 PCA 降维是否过时时抽样的片段数量"""
+
+def index_spec(config: dict, name: str) -> dict:
+    """某种数据库的索引配置，stores 中对应数据库的配置会覆盖全局配置"""
+    spec = { key: value for key, value in config.items() if key != "stores" }
+    spec.update(config.get("stores", {}).get(name, {}))
+    if spec.get("type", "flat") not in INDEX_TYPES:
+        print(f"Warn: Unknown index type \"{spec['type']}\" for {name} store, using flat index.")
+        spec["type"] = "flat"
+    if spec.get("compression", "none") not in COMPRESSIONS:
+        print(f"Warn: Unknown compression \"{spec['compression']}\" for {name} store, vectors will not be compressed.")
+        spec["compression"] = "none"
+    if spec.get("projection", "none") not in PROJECTIONS:
+        print(f"Warn: Unknown projection \"{spec['projection']}\" for {name} store, vectors will not be projected.")
+        spec["projection"] = "none"
+    return spec
+
+def index_layers(index: faiss.Index) -> list[faiss.Index]:
+    """由外到内列出索引的各层：精确重排、降维投影、实际检索的索引"""
+    layers = [index]
+    while True:
+        if isinstance(index, faiss.IndexRefine):
+            index = faiss.downcast_index(index.base_index)
+        elif isinstance(index, faiss.IndexPreTransform):
+            index = faiss.downcast_index(index.index)
+        else:
+            return layers
+        layers.append(index)
+
+def base_index(index: faiss.Index) -> faiss.Index:
+    """去掉精确重排与降维投影外层后的索引"""
+    return index_layers(index)[-1]
+
+def refine_layer(index: faiss.Index) -> faiss.IndexRefine:
+    return next((layer for layer in index_layers(index) if isinstance(layer, faiss.IndexRefine)), None)
+
+def projection_matrix(index: faiss.Index) -> faiss.VectorTransform:
+    """索引使用的降维投影，没有投影时返回 None"""
+    layer = next((layer for layer in index_layers(index) if isinstance(layer, faiss.IndexPreTransform)), None)
+    if layer is None:
+        return None
+    return faiss.downcast_VectorTransform(layer.chain.at(0))
+
+def index_projection(index: faiss.Index) -> tuple[str, int]:
+    """返回 (降维方式, 降维后的维度)"""
+    matrix = projection_matrix(index)
+    if isinstance(matrix, faiss.PCAMatrix):
+        return "pca", matrix.d_out
+    if isinstance(matrix, faiss.RandomRotationMatrix):
+        return "random", matrix.d_out
+    return "none", index.d
+
+def index_type(index: faiss.Index) -> str:
+    index = base_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+def index_compression(index: faiss.Index) -> str:
+    index = base_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    if isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "fp16" if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    if isinstance(index, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    return "none"
+
+def is_lossless(index: faiss.Index) -> bool:
+    """索引能否还原出原始向量，压缩或降维后只有带精确重排的索引还保留原始向量"""
+    if refine_layer(index) is not None:
+        return True
+    return index_compression(index) == "none" and projection_matrix(index) is None
+
+def is_exact(index: faiss.Index) -> bool:
+    """是否为不压缩、不降维的精确检索"""
+    return index_type(index) == "flat" and index_compression(index) == "none" and projection_matrix(index) is None
+
+def target_type(spec: dict, count: int) -> str:
+    """向量数量低于 min_size 时使用精确检索，近似索引在小数据量下没有收益"""
+    if count < spec.get("min_size", 10000):
+        return "flat"
+    return spec.get("type", "flat")
+
+def target_compression(spec: dict, count: int) -> str:
+    """向量数量不足以训练乘积量化时退回 8 位标量量化"""
+    compression = spec.get("compression", "none")
+    if compression == "pq" and count < PQ_MIN_TRAIN:
+        return "sq8"
+    return compression
+
+def target_projection(spec: dict, count: int, dim: int) -> tuple[str, int]:
+    """返回 (降维方式, 降维后的维度)，目标维度不小于原维度，或 PCA 的训练向量少于原维度时不降维"""
+    projection = spec.get("projection", "none")
+    out_dim = spec.get("projection_dim", 256)
+    if projection == "none" or out_dim >= dim or (projection == "pca" and count < dim):
+        return "none", dim
+    return projection, out_dim
+
+def rescore_enabled(spec: dict, count: int, dim: int) -> bool:
+    lossy = target_compression(spec, count) != "none" or target_projection(spec, count, dim)[0] != "none"
+    return lossy and spec.get("rescore", 0) > 0
+
+def pq_subquantizers(spec: dict, dim: int) -> int:
+    """PQ 子量化器数量，必须整除向量维度，未配置时每个子向量约 8 维"""
+    m = min(spec.get("pq_m") or max(1, dim // 8), dim)
+    while dim % m:
+        m -= 1
+    return m
+
+def ivf_nlist(spec: dict, count: int) -> int:
+    """IVF 的聚类数量，未配置时取 4·√n，并保证每个聚类至少有 39 个训练向量"""
+    nlist = spec.get("nlist") or int(4 * math.sqrt(count))
+    return max(1, min(nlist, count // 39))
+
+def index_vectors(index: faiss.Index) -> np.ndarray:
+    """取出索引中的全部向量，顺序与向量位置一致"""
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+def projection_error(index: faiss.Index, vectors: np.ndarray) -> float:
+    """降维丢失的方差占比，没有降维时为 0"""
+    matrix = projection_matrix(index)
+    if matrix is None or len(vectors) == 0:
+        return 0.0
+    # PCA 与随机投影的矩阵行向量都是正交的，投影到子空间再还原即为 AᵀA·x
+    A = faiss.vector_to_array(matrix.A).reshape(matrix.d_out, matrix.d_in)
+    centered = vectors - vectors.mean(axis=0)
+    variance = float(np.sum(centered ** 2))
+    residual = centered - (centered @ A.T) @ A
+    return float(np.sum(residual ** 2)) / variance if variance > 0 else 0.0
+
+def index_bytes(index: faiss.Index) -> int:
+    """索引序列化后的大小"""
+    return len(faiss.serialize_index(index))
+
+def tune_index(index: faiss.Index, spec: dict):
+    """设置检索参数，这些参数不影响索引结构，随时可以修改"""
+    refine = refine_layer(index)
+    if refine is not None:
+        # 先取 k × rescore 个候选，再用原始向量精确计算距离
+        refine.k_factor = spec.get("rescore", 0)
+    index = base_index(index)
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = spec.get("nprobe", 16)
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = spec.get("ef_search", 64)
+
+def index_description(spec: dict, count: int, dim: int) -> str:
+    """按配置生成 faiss.index_factory 的索引描述"""
+    projection, out_dim = target_projection(spec, count, dim)
+    codec = {
+        "none": "Flat",
+        "fp16": "SQfp16",
+        "sq8": "SQ8",
+        "pq": f"PQ{pq_subquantizers(spec, out_dim)}"
+    }[target_compression(spec, count)]
+    kind = target_type(spec, count)
+    if kind == "hnsw":
+        description = f"HNSW{spec.get('hnsw_m', 32)},{codec}"
+    elif kind == "ivf":
+        description = f"IVF{ivf_nlist(spec, count)},{codec}"
+    else:
+        description = codec
+    if projection == "pca":
+        description = f"PCA{out_dim},{description}"
+    elif projection == "random":
+        description = f"RR{out_dim},{description}"
+    if rescore_enabled(spec, count, dim):
+        description += ",RFlat"
+    return description
+
+def build_index(vectors: np.ndarray, metric: int, spec: dict) -> faiss.Index:
+    """按配置构建索引，PCA、IVF 与量化器会先用这些向量训练"""
+    count, dim = vectors.shape
+    index = faiss.index_factory(dim, index_description(spec, count, dim), metric)
+    if isinstance(base_index(index), faiss.IndexHNSW):
+        base_index(index).hnsw.efConstruction = spec.get("ef_construction", 40)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    tune_index(index, spec)
+    return index
+
+def needs_rebuild(index: faiss.Index, spec: dict) -> bool:
+    """索引类型、压缩或降维方式与配置不符，或自动选择的 IVF 聚类数量与当前数据量相差过大时需要重建"""
+    count = index.ntotal
+    kind = target_type(spec, count)
+    if index_type(index) != kind or index_compression(index) != target_compression(spec, count):
+        return True
+    if index_projection(index) != target_projection(spec, count, index.d):
+        return True
+    if (refine_layer(index) is not None) != rescore_enabled(spec, count, index.d):
+        return True
+    if kind == "ivf":
+        nlist = ivf_nlist(spec, count)
+        return not (nlist / 2 <= base_index(index).nlist <= nlist * 2)
+    return False
+
+def recall_at_k(index: faiss.Index, k=10, samples=100, vectors: np.ndarray = None) -> float:
+    """抽样原始向量作为提问，计算索引检索结果相对精确检索的召回率
+
+    vectors 为原始向量，不提供时从索引中还原，压缩或降维且没有精确重排的索引只能还原出近似向量，此时只能反映近似检索本身的损失。
+    """
+    if vectors is None:
+        vectors = index_vectors(index)
+    if is_exact(index) or len(vectors) == 0:
+        return 1.0
+    k = min(k, len(vectors))
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), min(samples, len(vectors)), replace=False)]
+    exact = faiss.IndexFlat(index.d, index.metric_type)
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+    _, found = index.search(queries, k)
+    return float(np.mean([len(set(t) & set(f)) / k for t, f in zip(truth, found)]))
+
+def search_store(store: FAISS, vector: list[float], k: int, dead: frozenset[int] = frozenset()) -> list[tuple[Document, float]]:
+    """检索一个数据库，跳过 dead 中的向量位置
+
+    各种索引与降维、重排外层对 IDSelector 的支持不一致，这里多取一些候选再过滤，候选被过滤得不够 k 个时加倍重新检索。
+    """
+    if store is None or k <= 0 or store.index.ntotal == 0:
+        return []
+    query = np.array([vector], dtype=np.float32)
+    fetch = k + min(len(dead), k)
+    while True:
+        fetch = min(fetch, store.index.ntotal)
+        scores, positions = store.index.search(query, fetch)
+        found = [
+            (pos, score) for pos, score in zip(positions[0].tolist(), scores[0].tolist())
+            if pos != -1 and pos not in dead
+        ]
+        if len(found) >= k or fetch >= store.index.ntotal:
+            break
+        fetch *= 2
+    return [(store.docstore.search(store.index_to_docstore_id[pos]), score) for pos, score in found[:k]]
+
+def flat_index(d: int, metric_type: int) -> faiss.Index:
+    """与新建数据库相同类型的精确索引，同类型的索引才能直接 merge_from"""
+    return faiss.IndexFlatIP(d) if metric_type == faiss.METRIC_INNER_PRODUCT else faiss.IndexFlatL2(d)
+
+def delta_index(index: faiss.Index) -> faiss.Index:
+    """新增片段使用的空索引
+
+    新增片段使用精确检索，降维且没有精确重排的数据库检索得到的是降维后的距离，新增片段也要经过同一个投影才能与之比较。
+    """
+    matrix = projection_matrix(index)
+    if matrix is None or refine_layer(index) is not None:
+        return flat_index(index.d, index.metric_type)
+    # 通过序列化复制投影矩阵，不需要复制整个索引
+    writer = faiss.VectorIOWriter()
+    faiss.write_VectorTransform(matrix, writer)
+    reader = faiss.VectorIOReader()
+    reader.data = writer.data
+    return faiss.IndexPreTransform(faiss.read_VectorTransform(reader), flat_index(matrix.d_out, index.metric_type))
+
+def empty_delta(store: FAISS) -> FAISS:
+    """为数据库创建一个存放新增片段的空数据库"""
+    return FAISS(
+        store.embedding_function, delta_index(store.index), CompactDocstore(), {},
+        distance_strategy=store.distance_strategy
+    )
+
+def merge_stores(store: FAISS, other: FAISS, restore: Callable[[list[int]], np.ndarray] = None):
+    """将 other 合并到 store，近似索引与压缩索引不支持 merge_from，改为直接添加向量
+
+    片段记录直接在两个文档库间共享，不需要构建 Document。
+    other 的索引无法还原原始向量时，需要提供 restore 按位置取出 other 的原始向量。
+    """
+    ids = [other.index_to_docstore_id[pos] for pos in range(other.index.ntotal)]
+    start = store.index.ntotal
+    if isinstance(store.index, faiss.IndexFlat) and type(store.index) is type(other.index):
+        store.index.merge_from(other.index)
+    elif restore is not None and not is_lossless(other.index):
+        store.index.add(restore(list(range(other.index.ntotal))))
+    else:
+        store.index.add(index_vectors(other.index))
+    store.docstore.extend(other.docstore, ids)
+    store.index_to_docstore_id.update({ start + i: id for i, id in enumerate(ids) })
+
+def to_ranges(positions: list[int]) -> list[list[int]]:
+    """将向量位置压缩为 [起始, 结束) 区间列表"""
+    ranges: list[list[int]] = []
+    for pos in sorted(positions):
+        if ranges and ranges[-1][1] == pos:
+            ranges[-1][1] = pos + 1
+        else:
+            ranges.append([pos, pos + 1])
+    return ranges
+
+def remove_positions(store: FAISS, positions: set[int], restore: Callable[[list[int]], np.ndarray] = None):
+    """按向量位置批量删除，只需要一次索引删除与一次映射重建
+
+    HNSW 不支持删除，IVF 删除后不会重新编号，这些索引会保留训练结果，只用剩余的向量重新构建。
+    索引无法还原原始向量时，提供 restore 可以按位置取出剩余片段的原始向量，避免用近似向量重新构建。
+    """
+    if not positions:
+        return
+    if isinstance(store.index, faiss.IndexFlatCodes):
+        store.index.remove_ids(np.fromiter(positions, dtype=np.int64))
+    else:
+        keep = [pos for pos in range(store.index.ntotal) if pos not in positions]
+        if restore is not None and not is_lossless(store.index):
+            vectors = restore(keep)
+        else:
+            vectors = index_vectors(store.index)[keep]
+        index = faiss.clone_index(store.index)
+        index.reset()
+        index.add(vectors)
+        store.index = index
+    store.docstore.delete([store.index_to_docstore_id[pos] for pos in positions])
+    remaining = [id for pos, id in sorted(store.index_to_docstore_id.items()) if pos not in positions]
+    store.index_to_docstore_id = dict(enumerate(remaining))
+
+class IndexStorage:
+    """合并后的索引缓存格式
+
+    每种数据库只保存一个 FAISS 索引文件与一个紧凑的文档库文件，清单文件记录每个文档在索引中占用的向量区间，
+    启动时只需读取几个文件，不需要逐个文档反序列化再合并。
+    片段文本保存在单独的 UTF-8 文本文件中，文档库文件只保存偏移与元数据。
+
+    每次写入都使用带序号的新文件名，清单替换是唯一的提交点：中途崩溃时旧清单仍指向完整的旧文件，
+    正在内存映射的旧文本文件也不会被覆盖（Windows 上无法替换被映射的文件），不再引用的旧文件之后再删除。
+    """
+    VERSION = 3
+
+    path: str
+    """索引缓存所在的文件夹"""
+    manifest: dict
+    use_mmap: bool = True
+    """是否以内存映射方式读取片段文本"""
+
+    def __init__(self, path: str, use_mmap=True):
+        self.path = path
+        self.use_mmap = use_mmap
+        self.manifest = { "version": self.VERSION, "stores": {}, "documents": {} }
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.file("manifest.json"))
+
+    def store_file(self, manifest: dict, name: str, suffix: str) -> str:
+        """清单中一种数据库的索引（faiss）、文档库（docstore）或文本（text）文件，版本 3 之前的文件名不带序号"""
+        prefix = manifest.get("files", {}).get(name, name)
+        return self.file(f"{prefix}.{suffix}")
+
+    def cleanup(self):
+        """删除当前清单不再引用的文件，仍被映射等原因无法删除的文件留到下次再删"""
+        referenced = { "manifest.json" }
+        for name in self.manifest.get("stores", {}):
+            referenced.update(
+                os.path.basename(self.store_file(self.manifest, name, suffix)) for suffix in ("faiss", "docstore", "text")
+            )
+        for file in os.listdir(self.path):
+            if file in referenced or not file.endswith((".faiss", ".docstore", ".text", ".tmp")):
+                continue
+            try:
+                os.remove(self.file(file))
+            except OSError:
+                pass
+
+    def documents(self) -> dict[str, dict]:
+        """清单中记录的文档，键为文档相对路径，值为文档哈希及每种数据库中的向量区间"""
+        return self.manifest["documents"]
+
+    def load(self, embeddings: dict[str, Embeddings]) -> dict[str, FAISS]:
+        """读取合并后的索引，文件损坏或与清单不一致时返回 None"""
+        try:
+            with open(self.file("manifest.json"), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get("version") not in (1, 2, self.VERSION):
+                return None
+
+            stores: dict[str, FAISS] = {}
+            for name in STORE_NAMES:
+                count = manifest["stores"].get(name)
+                if count is None:
+                    stores[name] = None
+                    continue
+                # 整个数据库一次读入，避免逐个文档反序列化；当前版本的 faiss 只会内存映射 IVF 倒排表，
+                # 平面索引与重排（RFlat）保存的原始向量仍会完整读入内存。
+                # 内存映射的 IVF 倒排表是只读的，无法增量添加，按清单中的索引类型直接完整读入，
+                # 旧版清单没有记录类型时同样完整读入，只读一次
+                kind = manifest.get("index_types", {}).get(name, "ivf")
+                index = faiss.read_index(
+                    self.store_file(manifest, name, "faiss"), faiss.IO_FLAG_MMAP if kind != "ivf" else 0
+                )
+                with open(self.store_file(manifest, name, "docstore"), 'rb') as f:
+                    data = pickle.load(f)
+                if index.ntotal != count or len(data["ids"]) != count:
+                    return None
+                if manifest["version"] == 1:
+                    # 旧版文档库直接保存了片段文本与元数据，转换为紧凑格式，下次保存时写入新格式
+                    docstore = CompactDocstore()
+                    docstore.add({
+                        id: Document(id=id, page_content=text, metadata=metadata)
+                        for id, text, metadata in zip(data["ids"], data["texts"], data["metadatas"])
+                    })
+                else:
+                    docstore = CompactDocstore.read(data, self.store_file(manifest, name, "text"), self.use_mmap)
+                stores[name] = FAISS(
+                    embeddings[name], index, docstore, dict(enumerate(data["ids"])),
+                    distance_strategy=DistanceStrategy.COSINE
+                )
+        except Exception as e:
+            print(f"Warn: Failed to load index cache, all documents will be reindexed. exception: {e}")
+            return None
+
+        self.manifest = manifest
+        self.cleanup()
+        return stores
+
+    def save(
+        self, stores: dict[str, FAISS], doc_ids: dict[str, tuple[list[str], list[str], list[str]]], hashes: dict[str, str],
+        index_stats: dict[str, dict] = None
+    ):
+        """写入合并后的索引，数据库写入带新序号的文件，最后替换清单，中途崩溃不会留下不一致的缓存
+
+        清单中同时记录每个文档的内容哈希，与元数据不一致的文档会在下次启动时重新索引。
+        index_stats 为构建索引时测得的召回率与降维损失，压缩或降维后无法还原原始向量，下次启动时直接沿用。
+        """
+        os.makedirs(self.path, exist_ok=True)
+        serial = self.manifest.get("serial", 0) + 1
+        while any(file.split(".")[1:2] == [str(serial)] for file in os.listdir(self.path)):
+            serial += 1
+        manifest = {
+            "version": self.VERSION, "serial": serial, "stores": {}, "files": {}, "index_types": {}, "documents": {},
+            "index_stats": index_stats or {}
+        }
+        positions: dict[str, dict[str, int]] = {}
+
+        for name in STORE_NAMES:
+            store = stores.get(name)
+            if store is None:
+                continue
+            manifest["files"][name] = f"{name}.{serial}"
+            items = sorted(store.index_to_docstore_id.items())
+            data = store.docstore.write([id for _, id in items], self.store_file(manifest, name, "text"))
+            faiss.write_index(store.index, self.store_file(manifest, name, "faiss"))
+            with open(self.store_file(manifest, name, "docstore"), 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            manifest["stores"][name] = store.index.ntotal
+            manifest["index_types"][name] = index_type(store.index)
+            positions[name] = { id: pos for pos, id in items }
+
+        for path, ids in doc_ids.items():
+            ranges = { "hash": hashes.get(path) }
+            for name, type_ids in zip(STORE_NAMES, ids):
+                found = [positions[name][id] for id in type_ids if id in positions.get(name, {})]
+                if found:
+                    ranges[name] = to_ranges(found)
+            manifest["documents"][path] = ranges
+
+        with open(self.file("manifest.json.tmp"), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(self.file("manifest.json.tmp"), self.file("manifest.json"))
+        self.manifest = manifest
+        self.cleanup()
+
+    def tombstones(self, paths: list[str]) -> tuple[frozenset[int], frozenset[int], frozenset[int]]:
+        """按清单中的向量区间，返回一批文档在读取的三个数据库中的向量位置，用作快照的墓碑"""
+        tombstones = []
+        for name in STORE_NAMES:
+            positions: set[int] = set()
+            for path in paths:
+                for start, end in self.documents().get(path, {}).get(name, []):
+                    positions.update(range(start, end))
+            tombstones.append(frozenset(positions))
+        return tuple(tombstones)
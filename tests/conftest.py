@@ -0,0 +1,42 @@
+import os
+import sys
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "langbot_document"
+"""插件目录的名称不固定，测试中以这个名称导入插件包"""
+
+if PACKAGE not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        PACKAGE, os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT]
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE] = module
+    spec.loader.exec_module(module)
+
+import hashlib
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+
+class FakeEmbeddings(Embeddings):
+    """按词的哈希生成的确定性向量，测试中代替嵌入模型"""
+
+    def __init__(self, dim=16):
+        self.dim = dim
+
+    def vector(self, text: str) -> list[float]:
+        v = np.full(self.dim, 1e-3)
+        for word in text.split():
+            v[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.dim] += 1
+        return (v / np.linalg.norm(v)).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.vector(text)
+
+@pytest.fixture
+def embeddings():
+    return FakeEmbeddings()
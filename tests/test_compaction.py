@@ -0,0 +1,216 @@
+import os
+import json
+import threading
+from types import SimpleNamespace
+import pytest
+from conftest import FakeEmbeddings
+from langbot_document.parse import DocumentParser
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.json")
+
+def write_doc(root, name, i):
+    with open(os.path.join(root, "docs", name), "w", encoding="utf-8") as f:
+        f.write(
+            f"# Title {i}\n\nintro text number {i} about install plugin\n\n"
+            f"```python\n# comment {i}\ndef f{i}():\n    return {i}\n```\n\nafter code paragraph {i}\n"
+        )
+
+def start_parser(root, monkeypatch, retriever=None):
+    with open(os.path.join(root, "config.json"), encoding="utf-8") as f:
+        config = json.load(f)
+
+    def fetch_models(self):
+        # 索引引擎按模型对象区分文本与代码，两个模型不能是同一个对象
+        self.text_model = FakeEmbeddings()
+        self.code_model = FakeEmbeddings()
+
+    monkeypatch.setattr(DocumentParser, "fetch_models", fetch_models)
+    monkeypatch.setattr(DocumentParser, "create_retriever", lambda self: setattr(self, "retriever", retriever))
+    parser = DocumentParser(config, root)
+    parser.watcher.start = lambda: None
+    parser.startup([(os.path.join(root, "docs", name), config["mode"]) for name in config["files"]])
+    return parser
+
+def make_root(tmp_path):
+    root = str(tmp_path)
+    os.makedirs(os.path.join(root, "docs"))
+    os.makedirs(os.path.join(root, "data"))
+    with open(CONFIG, encoding="utf-8") as f:
+        config = json.load(f)
+    config["mode"] = "text-code"
+    config["files"] = [f"doc{i}.md" for i in range(10)]
+    config["stats_interval"] = 0
+    config["ingest"] = { **config.get("ingest", {}), "processes": 1 }
+    for i in range(10):
+        write_doc(root, f"doc{i}.md", i)
+    with open(os.path.join(root, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    return root
+
+@pytest.fixture
+def parser(tmp_path, monkeypatch):
+    parser = start_parser(make_root(tmp_path), monkeypatch)
+    yield parser
+    parser.close()
+
+def indexed_ids(snapshot, i=0):
+    """快照中第 i 种数据库与新增片段里未删除的片段 id"""
+    ids = set()
+    base, delta, dead = snapshot[i], snapshot.deltas[i], snapshot.tombstones[i]
+    if base is not None:
+        ids.update(id for pos, id in base.index_to_docstore_id.items() if pos not in dead)
+    if delta is not None:
+        ids.update(delta.index_to_docstore_id.values())
+    return ids
+
+def doc_path(parser, name):
+    return os.path.join(parser.root_path, "docs", name)
+
+def test_needs_compaction_after_delete(parser):
+    assert not parser.needs_compaction()
+    path = doc_path(parser, "doc0.md")
+    os.remove(path)
+
+    parser.reindex([(path, "delete")])
+
+    assert parser.snapshot.tombstones[0]
+    assert not any(id.startswith(os.path.join("docs", "doc0.md")) for id in indexed_ids(parser.snapshot))
+    assert parser.needs_compaction()
+
+    parser.compact()
+
+    assert not parser.needs_compaction()
+    assert parser.snapshot.pending_fraction() == 0
+
+def test_reindex_during_compaction(parser, monkeypatch):
+    deleted = doc_path(parser, "doc0.md")
+    os.remove(deleted)
+    parser.reindex([(deleted, "delete")])
+
+    merging = threading.Event()
+    release = threading.Event()
+    merge_pending = DocumentParser.merge_pending
+
+    def blocked_merge(self, snapshot):
+        merging.set()
+        assert release.wait(10)
+        return merge_pending(self, snapshot)
+
+    monkeypatch.setattr(DocumentParser, "merge_pending", blocked_merge)
+    compaction = threading.Thread(target=parser.compact)
+    compaction.start()
+    assert merging.wait(10)
+
+    # 合并期间删除一个文档并新增一个文档，重建索引不等待合并
+    removed = doc_path(parser, "doc1.md")
+    os.remove(removed)
+    added = doc_path(parser, "new.md")
+    write_doc(parser.root_path, "new.md", 42)
+    reindex = threading.Thread(target=parser.reindex, args=([(removed, "delete"), (added, "text-code")],))
+    reindex.start()
+    reindex.join(10)
+    assert not reindex.is_alive()
+    assert parser.compacting
+
+    release.set()
+    compaction.join(10)
+    assert not compaction.is_alive()
+
+    snapshot = parser.snapshot
+    ids = indexed_ids(snapshot)
+    names = { id.rsplit("-", 1)[0] for id in ids }
+    assert os.path.join("docs", "doc0.md") not in names
+    assert os.path.join("docs", "doc1.md") not in names
+    assert os.path.join("docs", "new.md") in names
+    # 合并在重建索引之前开始，新文档仍在新增片段中，删除的文档记入新数据库的墓碑
+    assert snapshot.deltas[0] is not None
+    assert snapshot.tombstones[0]
+    assert parser.compaction_journal is None
+    assert not parser.compacting
+
+    # 合并期间修改的文档在清单中不记录哈希，下次启动时重新索引
+    documents = parser.storage.documents()
+    assert documents[os.path.join("docs", "new.md")]["hash"] is None
+    assert documents[os.path.join("docs", "doc1.md")]["hash"] is None
+    assert documents[os.path.join("docs", "doc2.md")]["hash"] is not None
+
+def test_startup_publishes_cache_before_optimizing(parser, monkeypatch):
+    root = parser.root_path
+    parser.close()
+    # 停止期间删除一个文档，重新启动时清单中它的片段记入墓碑
+    os.remove(doc_path(parser, "doc0.md"))
+    seen = []
+    optimize_stores = DocumentParser.optimize_stores
+
+    def record(self, stores, check_recall=False):
+        if check_recall:
+            seen.append((self.progress.searchable(), indexed_ids(self.snapshot)))
+        return optimize_stores(self, stores, check_recall)
+
+    monkeypatch.setattr(DocumentParser, "optimize_stores", record)
+    restarted = start_parser(root, monkeypatch)
+    try:
+        searchable, ids = seen[0]
+        names = { id.rsplit("-", 1)[0] for id in ids }
+        assert searchable
+        assert os.path.join("docs", "doc0.md") not in names
+        assert os.path.join("docs", "doc1.md") in names
+        assert restarted.snapshot.pending_fraction() == 0
+        assert os.path.join("docs", "doc0.md") not in restarted.storage.documents()
+    finally:
+        restarted.close()
+
+def test_unchanged_restart_skips_embedding_cache_collection(parser, monkeypatch):
+    root = parser.root_path
+    parser.close()
+    collected = []
+    monkeypatch.setattr(DocumentParser, "collect_embedding_cache", lambda self: collected.append(True))
+
+    restarted = start_parser(root, monkeypatch)
+    restarted.close()
+    assert not collected
+
+    os.remove(doc_path(restarted, "doc0.md"))
+    restarted = start_parser(root, monkeypatch)
+    restarted.close()
+    assert collected
+
+def test_stale_manifest_entries_are_not_counted_from_cache(parser, monkeypatch):
+    root = parser.root_path
+    parser.close()
+    # 元数据中的哈希与文档一致，但清单中没有记录哈希（例如合并期间修改过），需要重新索引
+    manifest_path = os.path.join(root, "data", "index", "manifest.json")
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest["documents"][os.path.join("docs", "doc0.md")]["hash"] = None
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+
+    restarted = start_parser(root, monkeypatch)
+    restarted.close()
+
+    assert restarted.from_cache == 9
+    assert restarted.indexed == 1
+
+def test_cold_start_is_not_searchable_until_documents_are_indexed(tmp_path, monkeypatch):
+    seen = []
+    index_documents = DocumentParser.index_documents
+    merge_documents = DocumentParser.merge_documents
+
+    def record_index(self, items):
+        seen.append(("indexing", self.searchable()))
+        return index_documents(self, items)
+
+    def record_merge(self):
+        seen.append(("merging", self.searchable()))
+        return merge_documents(self)
+
+    monkeypatch.setattr(DocumentParser, "index_documents", record_index)
+    monkeypatch.setattr(DocumentParser, "merge_documents", record_merge)
+    retriever = SimpleNamespace(publish=lambda snapshot: None, shutdown=lambda: None)
+    parser = start_parser(make_root(tmp_path), monkeypatch, retriever)
+    parser.close()
+
+    # 没有索引缓存时读取后发布的快照是空的，第一批文档索引完成之前仍然显示 indexing_notice
+    assert seen == [("indexing", False), ("merging", True)]
+    assert parser.searchable()
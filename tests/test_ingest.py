@@ -0,0 +1,37 @@
+import os
+import multiprocessing
+from types import SimpleNamespace
+from langbot_document import ingest
+from langbot_document.ingest import IngestEngine
+from langbot_document.splitter import DocumentSplitter
+
+def write_docs(path, count):
+    docs = []
+    for i in range(count):
+        doc_path = os.path.join(path, f"doc{i}.md")
+        with open(doc_path, "w", encoding="utf-8") as f:
+            f.write(f"# Title {i}\n\nparagraph {i} about installing the plugin\n")
+        docs.append((doc_path, "text-only"))
+    return docs
+
+def test_split_all_falls_back_when_worker_dies(tmp_path, monkeypatch):
+    parent = os.getpid()
+    split = ingest.load_and_split
+
+    def crash_in_worker(doc_path, mode, splitter):
+        # 在子进程中直接退出模拟进程崩溃
+        if os.getpid() != parent:
+            os._exit(1)
+        return split(doc_path, mode, splitter)
+
+    monkeypatch.setattr(ingest, "load_and_split", crash_in_worker)
+    splitter = DocumentSplitter(code_context_length=1, chunk_size=100, chunk_overlap=10)
+    engine = IngestEngine(SimpleNamespace(splitter=splitter), processes=2)
+    # 子进程需要继承上面的替换，测试中使用 fork 启动
+    engine.mp_context = multiprocessing.get_context("fork")
+    items = write_docs(tmp_path, 4)
+
+    results = engine.split_all(items)
+
+    assert sorted(path for path, _, _ in results) == sorted(path for path, _ in items)
+    assert all(chunks for _, chunks, _ in results)
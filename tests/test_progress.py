@@ -0,0 +1,17 @@
+from langbot_document.progress import IndexProgress
+
+def test_render_replaces_known_placeholders_only():
+    progress = IndexProgress()
+    progress.begin("indexing", 8)
+    progress.advance(2)
+
+    notice = progress.render("{stage} {done}/{total} {percent}% {eta_seconds}s {unknown} {} {percent:.0f}")
+
+    assert notice.startswith("indexing 2/8 25% ")
+    assert notice.endswith("s {unknown} {} {percent:.0f}")
+
+def test_render_when_ready():
+    progress = IndexProgress()
+    progress.finish()
+
+    assert progress.render("{percent}% {stage}") == "100% ready"
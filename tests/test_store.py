@@ -0,0 +1,87 @@
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from langbot_document.docstore import CompactDocstore
+from langbot_document.store import IndexSnapshot, IndexStorage, search_store, empty_delta, merge_stores
+
+def build_store(embeddings, texts, prefix="doc"):
+    docs = [Document(page_content=text, id=f"{prefix}-{i}") for i, text in enumerate(texts)]
+    return FAISS.from_documents(docs, embeddings, ids=[doc.id for doc in docs])
+
+def brute_force(store, vector, k, dead=frozenset()):
+    """逐个计算距离，返回未删除的最近 k 个位置及其距离"""
+    vectors = store.index.reconstruct_n(0, store.index.ntotal)
+    distances = ((vectors - np.array(vector, dtype=np.float32)) ** 2).sum(axis=1)
+    order = [pos for pos in np.argsort(distances, kind="stable").tolist() if pos not in dead]
+    return order[:k], distances[order[:k]]
+
+def test_search_store_over_fetches_past_dead_results(embeddings):
+    store = build_store(embeddings, [f"word{i % 5} text{i}" for i in range(40)])
+    vector = embeddings.embed_query("word1")
+    # 最接近的结果全部删除，需要多次加倍重新检索才能取够 k 个
+    dead = frozenset(brute_force(store, vector, 12)[0])
+
+    results = search_store(store, vector, 5, dead)
+
+    _, distances = brute_force(store, vector, 5, dead)
+    dead_ids = { store.index_to_docstore_id[pos] for pos in dead }
+    assert len(results) == 5
+    assert not dead_ids & { doc.id for doc, _ in results }
+    # 距离相同的结果顺序不确定，只比较距离
+    assert np.allclose([score for _, score in results], distances, atol=1e-5)
+
+def test_search_store_returns_fewer_when_everything_is_dead(embeddings):
+    store = build_store(embeddings, ["a b", "b c", "c d"])
+
+    assert search_store(store, embeddings.embed_query("a"), 2, frozenset(range(3))) == []
+    assert len(search_store(store, embeddings.embed_query("a"), 5)) == 3
+
+def test_snapshot_search_merges_delta_and_skips_tombstones(embeddings):
+    base = build_store(embeddings, ["install plugin", "configure model", "install model"])
+    delta = empty_delta(base)
+    merge_stores(delta, build_store(embeddings, ["install plugin again"], prefix="new"))
+    dead = frozenset(pos for pos, id in base.index_to_docstore_id.items() if id == "doc-0")
+    snapshot = IndexSnapshot(base, None, None, deltas=(delta, None, None), tombstones=(dead, frozenset(), frozenset()))
+
+    ids = [doc.id for doc, _ in snapshot.search(0, embeddings.embed_query("install plugin"), 3)]
+
+    assert "doc-0" not in ids
+    assert ids[0] == "new-0"
+    assert sorted(ids) == ["doc-1", "doc-2", "new-0"]
+
+def test_pending_fraction(embeddings):
+    base = build_store(embeddings, [f"text {i}" for i in range(10)])
+    delta = build_store(embeddings, ["new text"], prefix="new")
+
+    assert IndexSnapshot(base, None, None).pending_fraction() == 0
+    assert IndexSnapshot(base, None, None, tombstones=(frozenset({1, 2}), frozenset(), frozenset())).pending_fraction() == 0.2
+    assert IndexSnapshot(base, None, None, deltas=(delta, None, None)).pending_fraction() == 0.1
+    assert IndexSnapshot(None, None, None, deltas=(delta, None, None)).pending_fraction() == 1
+
+def test_chunks_skips_tombstones(embeddings):
+    base = build_store(embeddings, [f"text {i}" for i in range(10)])
+    delta = build_store(embeddings, ["new text"], prefix="new")
+
+    assert IndexSnapshot(None, None, None).chunks() == 0
+    assert IndexSnapshot(base, None, None, deltas=(None, delta, None), tombstones=(frozenset({1, 2}), frozenset(), frozenset())).chunks() == 9
+
+def test_storage_reads_ivf_index_once(embeddings, tmp_path, monkeypatch):
+    store = build_store(embeddings, [f"word{i % 7} text{i}" for i in range(64)])
+    vectors = store.index.reconstruct_n(0, store.index.ntotal)
+    ivf = faiss.IndexIVFFlat(faiss.IndexFlatL2(vectors.shape[1]), vectors.shape[1], 4)
+    ivf.train(vectors)
+    ivf.add(vectors)
+    store.index = ivf
+    store.docstore = CompactDocstore.from_docstore(store.docstore, list(store.index_to_docstore_id.values()))
+    doc_ids = { "docs/a.md": ([id for id in store.index_to_docstore_id.values()], [], []) }
+    IndexStorage(str(tmp_path), False).save({ "text": store, "code": None, "comment": None }, doc_ids, { "docs/a.md": "hash" })
+
+    reads = []
+    read_index = faiss.read_index
+    monkeypatch.setattr(faiss, "read_index", lambda *args: reads.append(args) or read_index(*args))
+    loaded = IndexStorage(str(tmp_path), False).load({ "text": embeddings, "code": embeddings, "comment": embeddings })
+
+    assert len(reads) == 1
+    assert isinstance(loaded["text"].index, faiss.IndexIVFFlat)
+    assert loaded["text"].index.ntotal == 64
@@ -1,15 +1,24 @@
 import os
+import time
 import asyncio
 import threading
+import traceback
+from fnmatch import fnmatch
 import watchdog.events as ev
 from watchdog.observers import Observer
 from watchdog.observers.api import BaseObserver
 from watchdog.events import FileSystemEventHandler
 
-DEBOUNCE_TIME = 5
+DEFAULT_EXCLUDE = ["*.swp", "*.swx", "*~", "*.tmp", ".#*", ".git/**", "**/.git/**"]
+"""默认忽略的文件：编辑器交换文件、备份文件、临时文件与 git 目录"""
 
-def find_index(lst, condition):
-    return next((i for i, x in enumerate(lst) if condition(x)), -1)
+def coalesce(old: str, new: str) -> str:
+    """合并同一文件先后发生的两个操作"""
+    if old is None or new == 'delete':
+        return new
+    if new == 'modify' or old == 'delete':
+        return 'modify'
+    return old
 
 class Debounce:
     def __init__(self, func, wait):
@@ -59,24 +68,206 @@ class DocumentHandler(FileSystemEventHandler):
             self.watcher.update_store('delete', src_path)
             self.watcher.update_store('add', dest_path)
 
+class ReindexScheduler:
+    """重建索引调度器
+
+    文件变化后等待一段安静期再重建索引，持续有文件变化时最多等待 max_wait 秒，保证索引的陈旧程度有上限。
+    较大的批次会拆分为多次重建，每次之间如果有少量文件的新变化，会先处理这些变化再继续处理积压的批次。
+    """
+    quiet_period: float
+    """最后一次文件变化后等待的时间（秒）"""
+    max_wait: float
+    """第一次文件变化后最长等待的时间（秒）"""
+    max_batch_size: int
+    """每次重建索引最多处理的文件数"""
+    priority_max_files: int
+    """不超过此数量的新变化会插队到积压的批次之前"""
+    pending: dict[str, tuple[str, float]]
+    """等待安静期结束的变化，键为文件路径，值为 (操作, 第一次变化的时间)"""
+    backlog: list[tuple[str, str, float]]
+    """已经过了安静期、等待分批处理的变化"""
+    
+    def __init__(self, parser, loop: asyncio.AbstractEventLoop, quiet_period=2, max_wait=30, max_batch_size=64, priority_max_files=4):
+        self.parser = parser
+        self.loop = loop
+        self.quiet_period = quiet_period
+        self.max_wait = max(max_wait, quiet_period)
+        self.max_batch_size = max(1, max_batch_size)
+        self.priority_max_files = priority_max_files
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.backlog = []
+        self.first_event: float = None
+        self.last_event: float = None
+        self.wakeup = asyncio.Event()
+        self.reindexing = False
+        self.compaction: asyncio.Future = None
+        
+        self.batches = 0
+        self.reindexed = 0
+        self.skipped = 0
+        self.total_fresh = 0.0
+        self.last_fresh = 0.0
+        self.max_fresh = 0.0
+    
+    def submit(self, mode: str, path: str):
+        """记录一次文件变化，可以在任意线程中调用"""
+        now = time.monotonic()
+        with self.lock:
+            if not self.pending and not self.backlog and not self.reindexing:
+                print("Received document update, waiting for reindexing...")
+            old = self.pending.get(path)
+            if old is None:
+                self.pending[path] = (mode, now)
+            else:
+                self.pending[path] = (coalesce(old[0], mode), old[1])
+            if self.first_event is None:
+                self.first_event = now
+            self.last_event = now
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+    
+    def deadline(self) -> float:
+        """新变化可以开始重建索引的时间，没有新变化时返回 None"""
+        with self.lock:
+            if not self.pending:
+                return None
+            return min(self.last_event + self.quiet_period, self.first_event + self.max_wait)
+    
+    def take_pending(self) -> list[tuple[str, str, float]]:
+        """取出全部新变化，积压批次中的同一文件会与新变化合并"""
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.first_event = None
+            self.last_event = None
+            
+            items: list[tuple[str, str, float]] = []
+            queued = { path: (mode, at) for path, mode, at in self.backlog }
+            for path, (mode, at) in pending.items():
+                if path in queued:
+                    old_mode, at = queued[path]
+                    mode = coalesce(old_mode, mode)
+                items.append((path, mode, at))
+            self.backlog = [item for item in self.backlog if item[0] not in pending]
+        return items
+    
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            deadline = self.deadline()
+            now = time.monotonic()
+            
+            if deadline is not None and deadline <= now:
+                items = self.take_pending()
+                if len(items) <= self.priority_max_files:
+                    # 少量文件的变化直接处理，不用排在积压的大批次之后
+                    await self.reindex(items)
+                else:
+                    with self.lock:
+                        self.backlog.extend(items)
+                continue
+            
+            if self.backlog:
+                with self.lock:
+                    batch = self.backlog[:self.max_batch_size]
+                    del self.backlog[:self.max_batch_size]
+                await self.reindex(batch)
+                continue
+            
+            # 等待新的文件变化或安静期结束，不需要轮询
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), None if deadline is None else deadline - now)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def reindex(self, items: list[tuple[str, str, float]]):
+        started = min(at for _, _, at in items)
+        self.reindexing = True
+        try:
+            await self.loop.run_in_executor(None, self.reindex_batch, [(path, mode) for path, mode, _ in items])
+        except Exception as e:
+            print(f"Reindex failed. exception: {e}")
+            traceback.print_exc()
+        finally:
+            self.reindexing = False
+        
+        fresh = time.monotonic() - started
+        self.batches += 1
+        self.total_fresh += fresh
+        self.last_fresh = fresh
+        self.max_fresh = max(self.max_fresh, fresh)
+        
+        # 墓碑或新增片段积累到一定比例后在后台合并，不阻塞之后的重建索引调度
+        if (self.compaction is None or self.compaction.done()) and self.parser.needs_compaction():
+            self.compaction = self.loop.run_in_executor(None, self.compact)
+    
+    def compact(self):
+        try:
+            self.parser.compact()
+        except Exception as e:
+            print(f"Compaction failed. exception: {e}")
+            traceback.print_exc()
+    
+    def reindex_batch(self, items: list[tuple[str, str]]):
+        # 内容没有变化的修改（例如 touch、编辑器重新保存）不需要重建索引
+        to_reindex = [(path, mode) for path, mode in items if mode == 'delete' or not self.parser.is_unchanged(path)]
+        self.skipped += len(items) - len(to_reindex)
+        if not to_reindex:
+            print("Documents unchanged, skip reindexing.")
+            return
+        self.parser.reindex(to_reindex)
+        self.reindexed += len(to_reindex)
+    
+    def stats(self) -> dict:
+        """获取调度统计信息，time_to_fresh 为文件第一次变化到新索引发布的时间"""
+        now = time.monotonic()
+        with self.lock:
+            depth = len(self.pending) + len(self.backlog)
+            oldest = min([at for _, at in self.pending.values()] + [at for _, _, at in self.backlog], default=None)
+        return {
+            "queue_depth": depth,
+            "staleness_ms": (now - oldest) * 1000 if oldest is not None else 0.0,
+            "reindexing": self.reindexing,
+            "batches": self.batches,
+            "reindexed": self.reindexed,
+            "skipped": self.skipped,
+            "last_time_to_fresh_ms": self.last_fresh * 1000,
+            "avg_time_to_fresh_ms": self.total_fresh / self.batches * 1000 if self.batches else 0.0,
+            "max_time_to_fresh_ms": self.max_fresh * 1000
+        }
+
 class DocumentWatcher:
     observer: BaseObserver
     handler: DocumentHandler
     root: str
     
-    reindex_task: asyncio.Future = None
-    reindex_list: list[tuple[str, str]] = list()
-    reindexing: bool = False
+    scheduler: ReindexScheduler
+    scheduler_task: asyncio.Future = None
+    include: list[str]
+    """只监听匹配这些模式的文件，为空时监听全部文件"""
+    exclude: list[str]
+    """忽略匹配这些模式的文件"""
     
-    def __init__(self, root: str, path: str, parser):
+    def __init__(self, root: str, path: str, parser, config: dict = None):
+        config = config or {}
         self.root = root
+        self.path = path
         self.parser = parser
+        self.include = config.get("include") or []
+        self.exclude = config.get("exclude", DEFAULT_EXCLUDE)
         self.observer = Observer()
         self.handler = DocumentHandler(root, self)
         self.observer.schedule(self.handler, path, recursive=True)
         
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
+        self.scheduler = ReindexScheduler(
+            parser, self.loop,
+            quiet_period=config.get("quiet_period", 2),
+            max_wait=config.get("max_wait", 30),
+            max_batch_size=config.get("max_batch_size", 64),
+            priority_max_files=config.get("priority_max_files", 4)
+        )
         
         # 在独立线程中运行事件循环
         self.thread = threading.Thread(target=self.start_loop, daemon=True)
@@ -86,44 +277,27 @@ class DocumentWatcher:
         """ 事件循环在独立线程中运行 """
         self.loop.run_forever()
         
-    def update_store(self, mode: str, path: str):
-        if self.reindex_task:
-            self.reindex_task.cancel()
-        else:
-            print("Received document update, waiting for reindexing...")
-            
-        # 将文件修改操作添加至列表
-        idx = find_index(self.reindex_list, lambda x: x[0] == path)
-        if idx != -1:
-            _, m = self.reindex_list[idx]
-            if mode == 'modify':
-                self.reindex_list[idx] = [path, 'modify']
-            elif mode == 'delete':
-                self.reindex_list[idx] = [path, 'delete']
-            elif m == 'delete' and mode == 'add':
-                self.reindex_list[idx] = [path, 'modify']
-        else:
-            self.reindex_list.append([path, mode])
+    def accept(self, path: str) -> bool:
+        """按 include 与 exclude 判断是否需要处理该文件，模式匹配文档相对于 docs 文件夹的路径或文件名"""
+        rel_path = os.path.relpath(path, self.path).replace(os.sep, '/')
+        name = os.path.basename(path)
+        matches = lambda patterns: any(fnmatch(rel_path, p) or fnmatch(name, p) for p in patterns)
+        if self.include and not matches(self.include):
+            return False
+        return not matches(self.exclude)
         
-        self.reindex_task = asyncio.run_coroutine_threadsafe(self.reindex(), self.loop)
-        
-    async def reindex(self):
-        await asyncio.sleep(DEBOUNCE_TIME)
-        
-        # 不能同时重建俩索引，因此需要等待
-        while self.reindexing:
-            await asyncio.sleep(DEBOUNCE_TIME)
-            
-        self.reindex_task = None
-        to_reindex = self.reindex_list
-        self.reindex_list = list()
-        self.reindexing = True
-        self.parser.reindex(to_reindex)
-        self.reindexing = False
+    def update_store(self, mode: str, path: str):
+        if self.accept(path):
+            self.scheduler.submit(mode, path)
 
     def start(self):
+        self.scheduler_task = asyncio.run_coroutine_threadsafe(self.scheduler.run(), self.loop)
         self.observer.start()
         
     def end(self):
-        self.observer.stop()
-        self.observer.join()
+        # 启动索引完成之前插件就被卸载时，监听还没有开始
+        if self.observer.is_alive():
+            self.observer.stop()
+            self.observer.join()
+        if self.scheduler_task:
+            self.scheduler_task.cancel()